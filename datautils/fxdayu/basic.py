@@ -106,6 +106,14 @@ class BarReader(object):
     def __call__(self, symbols, trade_date, fields=None):
         pass
 
+    def range(self, symbols, start, end, fields=None, time=(None, None)):
+        """
+        读取多日分钟线
+
+        :param time: tuple, (start, end), HHMMSS格式的日内时间范围, None代表不限
+        """
+        pass
+
 
 class Predefine(SingleReader):
 
@@ -217,6 +225,8 @@ class DataAPIBase(object):
 
     _external = {}
 
+    cache = None
+
     def set_external(self, ext):
         if isinstance(ext, dict):
             if len(ext):
@@ -234,7 +244,29 @@ class DataAPIBase(object):
     
     external = property(get_external, set_external, del_external)
 
+    def set_cache(self, cache):
+        """
+        为所有已注册及之后注册的reader加上查询结果缓存。
+
+        :param cache: datautils.tools.cache.QueryCache | None, None代表取消缓存
+        """
+        self.cache = cache
+        for key, value in list(self.methods.items()):
+            self[key] = value
+
+    def enable_cache(self, max_bytes=256*1024*1024, ttl=300):
+        from datautils.tools.cache import QueryCache
+
+        self.set_cache(QueryCache(max_bytes, ttl))
+        return self.cache
+
     def __setitem__(self, key, value):
+        from datautils.tools.cache import CachedReader
+
+        if isinstance(value, CachedReader):
+            value = value.reader
+        if self.cache is not None:
+            value = CachedReader(value, key, self.cache)
         self.methods[key] = value
         if key in VIEWS:
             attr = VIEWS[key]
@@ -4,9 +4,107 @@ from collections import Iterable
 import os
 from datautils.fxdayu.basic import SingleReader, DailyReader, SingleMapReader
 import logging
-from datautils.sql import make_command
-import sqlite3
+from datautils.sql import make_query, SqliteConnection
+from datautils.tools.frame import to_long
+from datautils.tools.cache import invalidate
+from datautils.tools.hdf_layout import get_layout, SYMBOL_MAJOR
 import numpy as np
+from threading import RLock, Timer
+from time import time
+from contextlib import contextmanager
+
+
+class HDFFilePool(object):
+
+    def __init__(self, mode="r", linger=1):
+        """
+        hdf文件句柄池
+
+        :param linger: int | float, 句柄空闲超过linger秒后关闭, 避免长期持有文件锁使其他进程无法写入或替换文件。
+                       None代表不主动关闭。
+        """
+        self.mode = mode
+        self.linger = linger
+        self.lock = RLock()
+        self.handles = {}
+        self.locks = {}
+        self.versions = {}
+        self.used = {}
+        self.timer = None
+
+    def version(self, file_name):
+        return self.versions.get(file_name, 0)
+
+    def _lock(self, file_name):
+        with self.lock:
+            return self.locks.setdefault(file_name, RLock())
+
+    @contextmanager
+    def open(self, file_name):
+        with self._lock(file_name):
+            handle = self.handles.get(file_name, None)
+            if handle is None or not handle.isopen:
+                handle = tables.File(file_name, self.mode)
+                self.handles[file_name] = handle
+            try:
+                yield handle
+            finally:
+                self.used[file_name] = time()
+                if self.linger is not None and self.linger <= 0:
+                    self._drop(file_name)
+        self._schedule()
+
+    def _schedule(self):
+        if self.linger is None or self.linger <= 0:
+            return
+        with self.lock:
+            if self.timer is None and self.handles:
+                self.timer = Timer(self.linger, self._reap)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _reap(self):
+        # 关闭空闲超过linger的句柄, 正在使用的句柄留到下一轮
+        with self.lock:
+            self.timer = None
+            locks = [(name, self.locks[name]) for name in self.handles]
+        now = time()
+        for name, lock in locks:
+            if not lock.acquire(False):
+                continue
+            try:
+                if now - self.used.get(name, 0) >= self.linger:
+                    self._drop(name)
+            finally:
+                lock.release()
+        self._schedule()
+
+    def invalidate(self, file_name=None):
+        with self.lock:
+            names = set(self.versions).union(self.handles) if file_name is None else [file_name]
+            for name in names:
+                self.versions[name] = self.version(name) + 1
+                self._close(name)
+
+    def release(self, file_name):
+        self._close(file_name)
+
+    def _close(self, file_name):
+        with self._lock(file_name):
+            self._drop(file_name)
+
+    def _drop(self, file_name):
+        handle = self.handles.pop(file_name, None)
+        if handle is not None and handle.isopen:
+            handle.close()
+
+    def close(self):
+        with self.lock:
+            for name in list(self.handles):
+                self._close(name)
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
 
 
 class HDFStructure(object):
@@ -14,6 +112,8 @@ class HDFStructure(object):
     index_name = "/date_flag"
     column_name="/symbol_flag"
     value_name="/data"
+    # 相邻两个读取位置间隔不超过max_gap时合并为一次hyperslab读取, 再在内存中筛选
+    max_gap = 512
 
     @classmethod
     def rename_axis(cls, index, column):
@@ -23,71 +123,95 @@ class HDFStructure(object):
             return type("Rename_HDFStructure", (cls,), {"index_name": index, "column_name": column})
 
     @classmethod
-    def from_root(cls, root):
+    def from_root(cls, root, pool=None):
+        return cls.from_files(*cls.list_files(root), pool=pool)
+
+    @staticmethod
+    def list_files(root):
         files = []
         for filename in os.listdir(root):
             
             if filename.endswith(".hd5"):
                 files.append(os.path.join(root, filename))
-        
-        return cls.from_files(*files)
+        return files
+
+    @staticmethod
+    def name_of(path):
+        filename = os.path.split(path)[1]
+        return filename[:-4].strip("_")
     
     @classmethod
-    def from_files(cls, *files):
+    def from_files(cls, *files, pool=None):
         structures = {}
         for path in files:
-            filename = os.path.split(path)[1]
-            name = filename[:-4].strip("_")
+            name = cls.name_of(path)
             try:
-                structure = cls(path)
+                structure = cls(path, pool)
             except Exception as e:
                 logging.error("load hdf error | %s | %s", path, e)
             else:
                 structures[name] = structure
         return structures
         
-    def __init__(self, hdf_file):
-        self.init(hdf_file)
-        self.m_time = os.path.getmtime(self.file_name)
-        self.load_indexes()
-        self.file.close()
-
-    def init(self, hdf_file):
+    def __init__(self, hdf_file, pool=None):
+        self.pool = pool if isinstance(pool, HDFFilePool) else HDFFilePool()
         if isinstance(hdf_file, tables.File):
-            self.file = hdf_file
-            self.file_name = self.file.filename
-        elif isinstance(hdf_file, str):
+            self.file_name = hdf_file.filename
+        else:
             self.file_name = hdf_file
-            self.file = tables.File(self.file_name, "r")
+        self.load_indexes()
 
     def load_indexes(self):
-        self.index = self._read_index(self.index_name)
-        if self.index.dtype == np.object:
-            self.index = self.index.map(lambda b: int(b))
-        self.column = self._read_index(self.column_name).map(lambda b: b.decode())
+        version = self.pool.version(self.file_name)
+        self.m_time = os.path.getmtime(self.file_name)
+        with self.pool.open(self.file_name) as f:
+            index = self._read_index(f, self.index_name)
+            column = self._read_index(f, self.column_name)
+            layout = get_layout(f.get_node(self.value_name))
+        self.symbol_major = layout == SYMBOL_MAJOR
+        if index.dtype == np.object:
+            index = index.map(lambda b: int(b))
+        self.index = index
+        self.column = column.map(lambda b: b.decode())
+        self.version = version
 
     def refresh(self):
-        if self.file.isopen:
-            self.file.close()
-        self.__init__(
-            self.file_name
-        )
-
-    def __del__(self):
-        if self.file.isopen:
-            self.file.close()
+        self.pool.invalidate(self.file_name)
+        self.load_indexes()
 
     def value(self, idx, col):
-        self.init(self.file_name)
-        m_time = os.path.getmtime(self.file_name)
-        if m_time > self.m_time:
-            self.m_time = m_time
-            self.load_indexes()
-        data = self.file.get_node(self.value_name)[idx, col]
-        self.file.close()
+        rows, row_order = self._runs(idx, self.max_gap)
+        # symbol-major布局下symbol为主轴, 合并间隔会读入中间symbol的全部历史, 因此不合并
+        cols, col_order = self._runs(col, 0 if self.symbol_major else self.max_gap)
+        with self.pool.open(self.file_name) as f:
+            node = f.get_node(self.value_name)
+            data = self._concat([
+                self._concat([self._take(self._slab(node, r, c), r_take, c_take) for c, c_take in cols], 1)
+                for r, r_take in rows
+            ], 0)
+        if row_order is not None:
+            data = data[row_order]
+        if col_order is not None:
+            data = data[:, col_order]
         return data
 
+    @staticmethod
+    def _take(block, rows, cols):
+        if rows is not None:
+            block = block[rows]
+        if cols is not None:
+            block = block[:, cols]
+        return block
+
+    def _slab(self, node, rows, cols):
+        if self.symbol_major:
+            return node[cols, rows].T
+        else:
+            return node[rows, cols]
+
     def read(self, index, columns):
+        if self.version != self.pool.version(self.file_name):
+            self.load_indexes()
         try:
             index_loc, idx = self._loc(self.index, index)
             column_loc, col = self._loc(self.column, columns)
@@ -97,8 +221,9 @@ class HDFStructure(object):
         data = self.value(index_loc, column_loc)
         return pd.DataFrame(data, idx, col)
 
-    def _read_index(self, name):
-        return pd.Index(self.file.get_node(name)[:, 0])
+    @staticmethod
+    def _read_index(f, name):
+        return pd.Index(f.get_node(name)[:, 0])
 
     @staticmethod
     def _loc(index, locs):
@@ -106,39 +231,155 @@ class HDFStructure(object):
             slicer = index.slice_indexer(locs.start, locs.stop, locs.step, "loc")
             return slicer, index[slicer]
         elif isinstance(locs, Iterable) and not isinstance(locs, (str, bytes)):
-            indexer = list(HDFStructure._iter_loc(index, locs))
+            indexer = index.get_indexer_for(list(locs))
+            indexer = indexer[indexer >= 0]
             return indexer, index[indexer]
         elif locs is None:
             return slice(None), index[:]
         else:
             indexer = index.get_loc(locs)
-            if not isinstance(indexer, Iterable):
-                indexer = [indexer]
+            if isinstance(indexer, slice):
+                return indexer, index[indexer]
+            elif isinstance(indexer, np.ndarray):
+                indexer = np.flatnonzero(indexer)
+            else:
+                indexer = np.array([indexer])
             return indexer, index[indexer]
 
     @staticmethod
-    def _iter_loc(index, loc):
-        for name in loc:
-            try:
-                yield index.get_loc(name)
-            except:
-                pass
+    def _runs(loc, max_gap=0):
+        # 将位置按间隔不超过max_gap分组, 每组读取一个hyperslab: [(slice, 组内位置或None)],
+        # 并返回恢复原顺序所需的indexer
+        if isinstance(loc, slice):
+            return [(loc, None)], None
+        positions = np.unique(loc)
+        if len(positions) == 0:
+            return [(slice(0, 0), None)], None
+        breaks = np.flatnonzero(np.diff(positions) > max_gap + 1) + 1
+        runs = []
+        for group in np.split(positions, breaks):
+            start, stop = int(group[0]), int(group[-1]) + 1
+            runs.append((slice(start, stop), None if len(group) == stop - start else group - start))
+        if len(positions) == len(loc) and (positions == loc).all():
+            return runs, None
+        return runs, np.searchsorted(positions, loc)
 
+    @staticmethod
+    def _concat(blocks, axis):
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks, axis)
 
-from threading import Timer, RLock
-from time import time
+
+import hashlib
+import json
+
+
+class MMapStructure(HDFStructure):
+    """
+    将hdf中的/data导出为.npy文件, 以np.load(mmap_mode='r')读取。
+    相同的date, symbol索引按内容共享同一个文件。源文件改变时重新导出。
+    """
+
+    cache_root = "."
+
+    @classmethod
+    def with_cache(cls, cache_root):
+        return type("MMap_%s" % cls.__name__, (cls,), {"cache_root": cache_root})
+
+    def cache_path(self, *names):
+        return os.path.join(self.cache_root, *names)
+
+    def load_indexes(self):
+        version = self.pool.version(self.file_name)
+        stat = os.stat(self.file_name)
+        meta = self.load_meta()
+        if meta is None or meta["mtime"] != stat.st_mtime or meta["size"] != stat.st_size:
+            meta = self.export(stat)
+        self.m_time = stat.st_mtime
+        self.index = pd.Index(np.load(self.cache_path("_index", meta["index"])))
+        self.column = pd.Index(np.load(self.cache_path("_index", meta["column"])))
+        self.data = np.load(self.cache_path(meta["data"]), mmap_mode="r")
+        self.symbol_major = False
+        self.version = version
+
+    def load_meta(self):
+        try:
+            with open(self.cache_path(self.name_of(self.file_name) + ".json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def export(self, stat):
+        name = self.name_of(self.file_name)
+        HDFStructure.load_indexes(self)
+        meta = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "data": name + ".npy",
+            "index": self.save_index(np.asarray(self.index)),
+            "column": self.save_index(np.asarray(self.column, dtype=str))
+        }
+        tmp = self.cache_path("%s.%s.tmp" % (meta["data"], os.getpid()))
+        shape = (len(self.index), len(self.column))
+        with self.pool.open(self.file_name) as f:
+            node = f.get_node(self.value_name)
+            data = np.lib.format.open_memmap(tmp, "w+", node.dtype, shape)
+            step = 256
+            for start in range(0, shape[0], step):
+                data[start:start+step] = self._slab(node, slice(start, start+step), slice(None))
+            data.flush()
+            del data
+        self.pool.release(self.file_name)
+        os.replace(tmp, self.cache_path(meta["data"]))
+        self.dump(meta, self.cache_path(name + ".json"))
+        logging.warning("export hdf to npy | %s | %s", self.file_name, shape)
+        return meta
+
+    def save_index(self, values):
+        key = hashlib.sha1(values.dtype.str.encode() + values.tobytes()).hexdigest()
+        filename = key + ".npy"
+        path = self.cache_path("_index", filename)
+        if not os.path.isfile(path):
+            tmp = "%s.%s.tmp" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp, path)
+        return filename
+
+    @staticmethod
+    def dump(meta, path):
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    def value(self, idx, col):
+        if isinstance(idx, slice) or isinstance(col, slice):
+            return self.data[idx][:, col]
+        else:
+            return self.data[np.ix_(idx, col)]
+
+
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+import sys
 import os
 
 
 class HDFDaily(SingleMapReader):
 
-    def __init__(self, root, cls, view, mapper=None):
+    def __init__(self, root, cls, view, mapper=None, workers=4, linger=1):
         super(HDFDaily, self).__init__(mapper)
         self.default_values = set(self.mapper.values())
         self.lock = RLock()
+        self.pool = HDFFilePool(linger=linger)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
         self.cls = cls
         self.root = root
         self.view = view
+        self.files = {}
+        self.stats = {}
         self.refresh()
         self.symbol = self.mapper.get("symbol", "symbol")
         self.date = self.mapper.get("trade_date", "trade_date")
@@ -149,71 +390,140 @@ class HDFDaily(SingleMapReader):
         p.update(self.default_values)
         return p
 
-    def gen_files(self):
+    def list_files(self):
         root = self.root
-        Structure = self.cls
         if isinstance(root, str): 
-            return Structure.from_root(root)
+            return self.cls.list_files(root)
+        elif isinstance(root, list):
+            return list(root)
+        else:
+            return []
+
+    def directories(self):
+        root = self.root
+        if isinstance(root, str):
+            return [root]
         elif isinstance(root, list):
-            return Structure.from_files(*root)
+            return sorted(set([os.path.dirname(os.path.abspath(path)) for path in root]))
         else:
-            return {}
+            return []
+
+    def stat_files(self):
+        stats = {}
+        for path in self.list_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (stat.st_mtime, stat.st_size)
+        return stats
 
     def read(self, fields=None, **filters):
         symbol = filters.get(self.symbol, None)
         dates = [int(date) if date else date for date in filters.get(self.date, (None, None))]
         dates = slice(*dates)
+        with self.lock:
+            files = self.files
         if fields is None:
-            fields = list(self.files.keys())
+            fields = list(files.keys())
         elif isinstance(fields, str):
             fields = [fields]
         
-        self.lock.acquire()
-        dct = {}
+        futures = {}
         for field in fields:
             try:
-                struct = self.files[field]
+                struct = files[field]
             except KeyError:
                 logging.error("hdf read | %s | %s | %s | field not exists", field, dates, symbol)
                 continue
+            futures[field] = self.executor.submit(struct.read, dates, symbol)
+        dct = {}
+        for field, future in futures.items():
             try:
-                data = struct.read(dates, symbol)
+                data = future.result()
             except Exception as e:
                 logging.error("hdf read | %s | %s | %s | %s", field, dates, symbol, e)
                 dct[field] = pd.DataFrame()
             else:
                 dct[field] = data
-        self.lock.release()
-        pn = pd.Panel.from_dict(dct)
-        pn.major_axis.name = self.date
-        pn.minor_axis.name = self.symbol
-        result = pn.to_frame(False)
         for name in [self.date, self.symbol]:
-            if name in result:
-                result.pop(name)
-        return result.reset_index()
+            dct.pop(name, None)
+        return to_long(dct, self.date, self.symbol)
 
     def refresh(self):
         logging.warning("%s | HDF start refresh", self.view)
-        self.lock.acquire()
-        self.files = self.gen_files()
-        for name in self.files:
-            self.mapper["%s.%s" % (self.view, name)] = name
-        self.lock.release()
+        stats = self.stat_files()
+        self.pool.invalidate()
+        files = self.cls.from_files(*stats, pool=self.pool)
+        stats = {path: stat for path, stat in stats.items() if self.cls.name_of(path) in files}
+        self.swap(files, stats)
+        invalidate(self.view)
         logging.warning("%s | HDF refresh accomplish", self.view)
 
+    def sync(self):
+        """
+        对比文件的mtime和size, 只重新加载新增或改动的文件, 删除已不存在的文件。
+
+        :return: set, 发生变化的字段名
+        """
+        stats = self.stat_files()
+        changed = [path for path, stat in stats.items() if self.stats.get(path, None) != stat]
+        removed = [path for path in self.stats if path not in stats]
+        if len(changed) == 0 and len(removed) == 0:
+            return set()
+
+        for path in changed + removed:
+            self.pool.invalidate(path)
+        loaded = self.cls.from_files(*changed, pool=self.pool)
+        with self.lock:
+            files = self.files.copy()
+        for path in removed:
+            files.pop(self.cls.name_of(path), None)
+        for path in changed:
+            name = self.cls.name_of(path)
+            if name in loaded:
+                files[name] = loaded[name]
+            else:
+                # 加载失败(如文件正在写入), 不记录状态以便下次重试
+                stats.pop(path)
+                if path in self.stats:
+                    stats[path] = self.stats[path]
+        self.swap(files, stats)
+        names = set([self.cls.name_of(path) for path in removed])
+        names.update(loaded)
+        if names:
+            invalidate(self.view)
+            logging.warning("%s | HDF sync | changed: %s | removed: %s", self.view, len(loaded), len(removed))
+        return names
+
+    def swap(self, files, stats):
+        for name in files:
+            self.mapper["%s.%s" % (self.view, name)] = name
+        with self.lock:
+            for name in set(self.files).difference(files):
+                self.mapper.pop("%s.%s" % (self.view, name), None)
+            self.files = files
+            self.stats = stats
+
 
 class HDFScanner(object):
 
-    def __init__(self, views):
+    def __init__(self, views, interval=60, inotify=False):
         self.running = False
+        self.interval = interval
         self.last_refresh_time = time()
         self.timer = Timer(1, self.loop)
         self.lock = RLock()
         self.views = views
+        self.dirty = set()
+        self.inotify = inotify and sys.platform.startswith("linux")
+        self.notifier = None
+        self.watches = {}
     
     def start(self):
         self.running = True
+        if self.inotify:
+            self.watch()
         self.timer.start()
     
     def stop(self):
@@ -221,9 +531,13 @@ class HDFScanner(object):
     
     def loop(self):
         if self.running:
-            if time() - self.last_refresh_time >= 3600:
-                self.refresh()
+            if time() - self.last_refresh_time >= self.interval:
+                self.sync()
                 self.last_refresh_time = time()
+            elif self.dirty:
+                with self.lock:
+                    names, self.dirty = self.dirty, set()
+                self.sync(names)
             self.timer = Timer(1, self.loop)
             self.timer.start()
         else:
@@ -233,6 +547,44 @@ class HDFScanner(object):
         for view_name, hdf_view in self.views.items():
             logging.warning("Refresh %s", view_name)
             hdf_view.refresh()
+
+    def sync(self, names=None):
+        for view_name, hdf_view in self.views.items():
+            if names is not None and view_name not in names:
+                continue
+            try:
+                hdf_view.sync()
+            except Exception as e:
+                logging.error("HDF sync | %s | %s", view_name, e)
+
+    def watch(self):
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            logging.error("HDFScanner | inotify_simple not installed, use polling only")
+            return
+
+        self.notifier = INotify()
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE | flags.CREATE
+        for view_name, hdf_view in self.views.items():
+            for directory in hdf_view.directories():
+                try:
+                    wd = self.notifier.add_watch(directory, mask)
+                except OSError as e:
+                    logging.error("HDFScanner | watch | %s | %s", directory, e)
+                else:
+                    self.watches.setdefault(wd, set()).add(view_name)
+        thread = Thread(target=self.listen)
+        thread.daemon = True
+        thread.start()
+
+    def listen(self):
+        while self.running:
+            for event in self.notifier.read(timeout=1000):
+                if event.name.endswith(".hd5"):
+                    with self.lock:
+                        self.dirty.update(self.watches.get(event.wd, ()))
+        self.notifier.close()
     
 
 class DailyPrice(DailyReader):
@@ -257,28 +609,23 @@ class DailyPrice(DailyReader):
 
 class LocalSqlite(SingleReader):
 
-    def __init__(self, sqlite_file, table):
+    def __init__(self, sqlite_file, table, conn=None):
         assert os.path.isfile(sqlite_file)
         self.file = sqlite_file
         self.table = table
+        self.conn = conn if conn is not None else SqliteConnection(sqlite_file)
         self.columns = self.get_columns()
     
     def get_columns(self):
-        conn = sqlite3.Connection(self.file)
-        cursor = conn.cursor()
-        cursor.execute("select * from %s" % self.table)
-        return set([record[0] for record in cursor.description])
+        return self.conn.columns(self.table)
 
     def __call__(self, index=None, fields=None, **filters):
         if fields is not None:
             if isinstance(fields, str):
                 fields = {fields}
             fields = self.columns.intersection(set(fields))
-        command = make_command(self.table, fields, **filters)
-        conn = sqlite3.Connection(self.file)
-        r = pd.read_sql(command, conn)
-        conn.close()
-        return r
+        command, params = make_query(self.table, fields, **filters)
+        return self.conn.read(command, params)
 
 
 def load_conf(dct):
@@ -294,7 +641,14 @@ def load_conf(dct):
 
 def load_sqlite(dct):
     sqlite_file = dct["file"]
-    return {key: LocalSqlite(sqlite_file, table) for key, table in dct.get("table_map", {}).items()}
+    conn = SqliteConnection(sqlite_file)
+    return {key: LocalSqlite(sqlite_file, table, conn) for key, table in dct.get("table_map", {}).items()}
+
+
+def make_cache_dirs(cache_root):
+    index_root = os.path.join(cache_root, "_index")
+    if not os.path.isdir(index_root):
+        os.makedirs(index_root)
 
 
 def load_hdf(conf):
@@ -309,15 +663,25 @@ def load_hdf(conf):
     view_map = conf.get("view_map", {})
     index = conf.get("index", "/date_flag")
     column = conf.get("column", "/symbol_flag")
+    workers = conf.get("workers", 4)
+    linger = conf.get("linger", 1)
 
-    Structure = HDFStructure.rename_axis(index, column)
+    if conf.get("backend", "hdf") == "mmap":
+        Structure = MMapStructure.rename_axis(index, column)
+    else:
+        Structure = HDFStructure.rename_axis(index, column)
 
     for view, root in views.items():
 
         mapper = fields_map.get(view_map.get(view, view), {})
-        r[view] = HDFDaily(root, Structure, view, mapper)
+        if issubclass(Structure, MMapStructure):
+            cache_root = os.path.join(conf.get("cache", "hdf_cache"), view)
+            make_cache_dirs(cache_root)
+            r[view] = HDFDaily(root, Structure.with_cache(cache_root), view, mapper, workers, linger)
+        else:
+            r[view] = HDFDaily(root, Structure, view, mapper, workers, linger)
     
-    scanner = HDFScanner(r.copy())
+    scanner = HDFScanner(r.copy(), conf.get("scan_interval", 60), conf.get("inotify", False))
     scanner.start()
     
     if conf.get("predefine", False):
@@ -1,7 +1,10 @@
 from datautils.fxdayu.basic import SingleReader, DailyReader, BarReader, SingleMapReader
-from datautils.mongodb.reader import ColReader, DBReader, ChunkDBReader
-from datautils.mongodb import read
+from datautils.mongodb.reader import ColReader, DBReader, ChunkDBReader, CollectionCatalog
+from datautils.mongodb import write_chunks, parser
+from datautils.tools.frame import stack_items
+from collections import OrderedDict
 import pandas as pd
+import numpy as np
 
 
 def expand(symbol):
@@ -88,7 +91,9 @@ class SDIReader(AppDBReader):
         return names, fields, filters
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import logging
 
 
 def convert2date(string, **replace):
@@ -133,7 +138,7 @@ class FactorReader(SDIReader, SingleMapReader):
         return data.sortlevel(1).reset_index()
 
     def predefine(self):
-        return self.db.collection_names()
+        return sorted(CollectionCatalog.of(self.db).names())
 
 class RangeColReader(ColReader):
 
@@ -202,14 +207,26 @@ class DailyDBReader(DailyReader):
                           datetime=(convert2date(start, hour=15), convert2date(end, hour=15)))
         for value in dct.values():
             value["trade_status"] = 1
-        pn = pd.Panel.from_dict(dct).rename_axis(date2int, 1)
-        pn.items.name = "symbol"
-        pn.major_axis.name = "trade_date"
-        frame =  pn.transpose(2, 1, 0).to_frame(False)
+        frame = stack_items(dct, "trade_date", "symbol", self.date)
         if isinstance(fields, set) and ("vwap" in fields):
             frame["vwap"] = frame["turnover"] / frame["volume"]
-        frame["trade_status"].fillna(0, inplace=True)
-        return frame.reset_index()
+        frame["trade_status"] = frame["trade_status"].fillna(0)
+        return frame
+
+    @staticmethod
+    def date(index):
+        index = pd.DatetimeIndex(index)
+        return np.asarray(index.year*10000+index.month*100+index.day, np.int64)
+
+
+def write_bar(db, data, **kwargs):
+    """
+    写入多日多品种的分钟线, 文档格式与BarDBReader读取的一致。
+
+    :param data: pandas.DataFrame, 包含symbol, datetime列
+    :param kwargs: 传给datautils.mongodb.write_chunks的参数
+    """
+    return write_chunks(db, data, "symbol", "datetime", unfold, **kwargs)
 
 
 class BarDBReader(BarReader):
@@ -219,23 +236,63 @@ class BarDBReader(BarReader):
 
     def __call__(self, symbols, trade_date, fields=None):
         dct = self.reader(symbols, "datetime", fields, _d=convert2date(trade_date))
-        for symbol, frame in dct.items():
+        return self.output(dct)
+
+    def range(self, symbols, start, end, fields=None, time=(None, None), days=5):
+        """
+        读取多日分钟线
+
+        :param symbols: list
+        :param start: 开始日期, 如 20180101
+        :param end: 结束日期
+        :param fields: 需要读取的字段
+        :param time: tuple, (start, end), HHMMSS格式的日内时间范围, 在服务端截取chunk
+        :param days: int, 每次查询包含的天数, 各symbol的各段日期并发查询
+        """
+        if isinstance(symbols, six.string_types):
+            symbols = [symbols]
+        if isinstance(fields, six.string_types):
+            fields = [fields]
+        blocks = list(self.split_dates(convert2date(start), convert2date(end), days))
+        tasks = [(symbol, block) for symbol in symbols for block in blocks]
+        parts = {}
+        with ThreadPoolExecutor(max_workers=max(min(self.reader.workers, len(tasks)), 1)) as executor:
+            futures = [(symbol, executor.submit(self.reader.read_window, symbol, "datetime", fields, time, _d=block))
+                       for symbol, block in tasks]
+            for symbol, future in futures:
+                try:
+                    parts.setdefault(symbol, []).append(future.result())
+                except Exception as e:
+                    logging.error("bar range | %s | %s | %s | %s | %s", symbol, start, end, time, e)
+        dct = {symbol: pd.concat(frames) for symbol, frames in parts.items()}
+        return self.output(dct)
+
+    @staticmethod
+    def split_dates(start, end, days):
+        step = timedelta(days=days)
+        while start <= end:
+            yield start, min(start + step - timedelta(days=1), end)
+            start += step
+
+    def output(self, dct):
+        items = OrderedDict()
+        for symbol in sorted(dct):
+            frame = dct[symbol]
             frame["code"] = fold(symbol)[:6]
-        pn = pd.Panel.from_dict(dct).rename_axis(fold)
-        pn.items.name = "symbol"
-        pn = pn.transpose(2, 1, 0)
-        for item, method in [("time", self.time), ("trade_date", self.date)]:
-            value = list(map(method, pn.major_axis))
-            pn[item] = pd.DataFrame(dict.fromkeys(pn.minor_axis, value), pn.major_axis)
-        return pn.to_frame(False).reset_index(level="symbol")
+            items[fold(symbol)] = frame
+        frame = stack_items(items, "datetime", "symbol")
+        index = pd.DatetimeIndex(frame["datetime"])
+        frame["time"] = self.time(index)
+        frame["trade_date"] = self.date(index)
+        return frame.set_index("datetime")
 
     @staticmethod
     def time(dt):
-        return dt.hour*10000+dt.minute*100+dt.second
+        return np.asarray(dt.hour*10000+dt.minute*100+dt.second, np.int64)
 
     @staticmethod
     def date(dt):
-        return dt.year*10000+dt.month*100+dt.day
+        return np.asarray(dt.year*10000+dt.month*100+dt.day, np.int64)
 
 class UpdateStatus(SingleReader):
 
@@ -258,9 +315,13 @@ class UpdateStatus(SingleReader):
         dates = self.trade_dates(trade_date=(start, end))
         dates = list(dates.trade_date.apply(str))
 
-        factor_status = self.factor_status(dates[0], dates[-1])
-        indicator_status = self.indicator_status(dates[0], dates[-1])
-        candle_status = self.candle_status(dates)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            factor_status = executor.submit(self.factor_status, dates[0], dates[-1])
+            indicator_status = executor.submit(self.indicator_status, dates[0], dates[-1])
+            candle_status = executor.submit(self.candle_status, dates)
+            factor_status = factor_status.result()
+            indicator_status = indicator_status.result()
+            candle_status = candle_status.result()
         status = pd.DataFrame({"factor": factor_status, "daily": candle_status, "secDailyIndicator": indicator_status})
         status.fillna(0, inplace=True)
         status["status"] = status.applymap(lambda s: 1 if s != 0 else 0).prod(axis=1)
@@ -274,21 +335,49 @@ class UpdateStatus(SingleReader):
         else:
             return None
 
+    @staticmethod
+    def _aggregate(collection, pipeline, key, value):
+        docs = list(collection.aggregate(pipeline))
+        return pd.Series([doc[value] for doc in docs], [doc[key] for doc in docs])
+
     def factor_status(self, start=None, end=None):
-        status = read(self.factor, index="date", date=(self._expand_date(start), self._expand_date(end)), local=2)
-        return status["local"].rename_axis(lambda s: s.replace("-", ""))
+        match = parser(date=(self._expand_date(start), self._expand_date(end)), local=2)
+        status = self._aggregate(self.factor, [
+            {"$match": match},
+            {"$group": {"_id": "$date", "local": {"$max": "$local"}}}
+        ], "_id", "local")
+        status.index = [date.replace("-", "") for date in status.index]
+        return status
 
     def indicator_status(self, start=None, end=None):
-        status = read(self.daily_indicator, index="trade_date", trade_date=(start, end))
-        return status.prod(axis=1)
+        # 每个文档中除trade_date外所有数值字段的乘积, 与DataFrame.prod(axis=1)一致跳过NaN
+        # (聚合框架中NaN与NaN相等, 因此用$ne排除)
+        numeric = {"$and": [
+            {"$in": [{"$type": "$$this.v"}, ["double", "int", "long", "decimal"]]},
+            {"$ne": ["$$this.v", float("nan")]}
+        ]}
+        product = {"$reduce": {
+            "input": {"$objectToArray": "$$ROOT"},
+            "initialValue": 1,
+            "in": {"$cond": [
+                {"$and": [numeric, {"$not": [{"$in": ["$$this.k", ["_id", "trade_date"]]}]}]},
+                {"$multiply": ["$$value", "$$this.v"]},
+                "$$value"
+            ]}
+        }}
+        return self._aggregate(self.daily_indicator, [
+            {"$match": parser(trade_date=(start, end))},
+            {"$project": {"_id": 0, "trade_date": 1, "status": product}}
+        ], "trade_date", "status")
 
     def candle_status(self, dates):
-        dct = {date: self._candle_status(date) for date in dates}
-        return pd.Series(dct)
-
-    def _candle_status(self, date):
-        date = self._expand_date(date)
-        return self.candle.find({"date": date, "D": 1}).count()
+        expanded = {self._expand_date(date): date for date in dates}
+        status = self._aggregate(self.candle, [
+            {"$match": {"date": {"$in": list(expanded)}, "D": 1}},
+            {"$group": {"_id": "$date", "count": {"$sum": 1}}}
+        ], "_id", "count")
+        status.index = [expanded[date] for date in status.index]
+        return status.reindex(dates, fill_value=0)
 
     def _get_col(self, db_col):
         db, col = db_col.split(".", 1)
@@ -324,6 +413,10 @@ def load_conf(dct):
         db = client[db_name]
         cls = DB_READER_MAP.get(view, DBReader)
         reader = cls(db)
+        if "WORKERS" in dct:
+            inner = getattr(reader, "reader", reader)
+            if isinstance(inner, DBReader):
+                inner.workers = dct["WORKERS"]
         if hasattr(reader, "predefine"):
             readers.setdefault("predefine", {})[view] = reader.predefine
         readers[view] = reader
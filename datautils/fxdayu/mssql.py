@@ -1,6 +1,14 @@
 import pymssql
-from datautils.sql import make_command
+from datautils.sql import make_query, build_query, split_filters, sp_executesql, sql_type, OrNull, iter_cursor, concat, \
+    STRING_TYPE
 from datautils.fxdayu.basic import SingleReader, MultiReader, single_fields_mapper, DailyReader, SingleMapReader
+from threading import Condition, RLock
+from contextlib import contextmanager
+from collections import deque
+from time import time
+import logging
+import json
+import os
 import pandas as pd
 import numpy as np
 
@@ -16,13 +24,40 @@ def reverse_map(dct):
 from collections import Iterable
 
 
+def create_temp(cursor, table, values, batch_size=1000, string_type=STRING_TYPE):
+    """建立单列(value)临时表并分批写入values, 每条insert最多1000行"""
+    cursor.execute("create table %s (value %s)" % (table, sql_type(values[0], string_type)))
+    for start in range(0, len(values), batch_size):
+        batch = values[start:start+batch_size]
+        cursor.execute(
+            "insert into %s (value) values %s" % (table, ",".join(["(%s)"] * len(batch))),
+            tuple(batch)
+        )
+
+
+def drop_temp(cursor, table):
+    try:
+        cursor.execute("drop table %s" % table)
+    except Exception as e:
+        logging.error("drop temp table | %s | %s", table, e)
+
+
 class SQLSingleReader(SingleMapReader):
 
-    def __init__(self, conn, table, mapper=None):
+    # IN筛选的元素个数超过该值时改为写入临时表筛选, None代表不使用临时表
+    in_threshold = 1024
+    # iter_read每块的行数
+    chunk_size = 50000
+    # 字符串参数声明的类型, 表中字符列为nvarchar时应改为nvarchar(4000)
+    string_type = STRING_TYPE
+
+    def __init__(self, conn, table, mapper=None, limits=None, in_threshold=in_threshold, string_type=string_type):
         super(SQLSingleReader, self).__init__(mapper)
         self.conn = conn
         self.table = table
-        self._limits = set()
+        self.in_threshold = in_threshold
+        self.string_type = string_type
+        self._limits = set(limits) if limits else set()
         self.limits()
         for limit in self._limits:
             self.mapper["%s.%s" % (self.table, limit)] = limit
@@ -41,12 +76,13 @@ class SQLSingleReader(SingleMapReader):
     
     def _find_limits(self):
         schema, table_name = self.table.split(".", 1)
-        cmd = make_command(
-            "information_schema.columns", ["COLUMN_NAME"], 
+        cmd, params = sp_executesql(*make_query(
+            "information_schema.columns", ["COLUMN_NAME"], "mssql",
             TABLE_NAME=table_name,
             TABLE_SCHEMA=schema
-        )
-        data = set(pd.read_sql(cmd, self.conn.connection())["COLUMN_NAME"])
+        ), string_type="nvarchar(128)")
+        with self.conn.checkout() as conn:
+            data = set(pd.read_sql(cmd, conn, params=params)["COLUMN_NAME"])
         return data
 
     def select_fields(self, fields):
@@ -63,13 +99,39 @@ class SQLSingleReader(SingleMapReader):
         return {name: filters[name] for name in fields}
 
     def read(self, fields=None, **filters):
+        return concat(self.iter_read(fields, **filters))
+
+    def iter_read(self, fields=None, chunk_size=None, **filters):
+        """
+        分块读取, 每块最多chunk_size行, 逐块筛选字段类型并填充空值。
+
+        :return: generator of pandas.DataFrame, 至少返回一块
+        """
         fields = self.select_fields(fields)
         filters = self.select_filters(filters)
-        command = make_command(self.table, fields, **filters)
-        with self.conn as conn:
-            data = pd.read_sql(command, conn).select_dtypes(include=[np.object, np.number]).fillna(0)
-            
-        return data
+        filters, large = split_filters(filters, self.in_threshold)
+        temp = {key: "#filter%d" % i for i, key in enumerate(sorted(large))}
+        subqueries = {key: "select value from %s" % table for key, table in temp.items()}
+        command, params = sp_executesql(
+            *build_query(self.table, fields, filters, "mssql", subqueries), string_type=self.string_type
+        )
+        with self.conn.checkout() as conn:
+            cursor = conn.cursor()
+            try:
+                for key, table in temp.items():
+                    create_temp(cursor, table, large[key], string_type=self.string_type)
+                if params is None:
+                    cursor.execute(command)
+                else:
+                    cursor.execute(command, params)
+                columns = None
+                for chunk in iter_cursor(cursor, chunk_size or self.chunk_size):
+                    if columns is None:
+                        columns = chunk.select_dtypes(include=[np.object, np.number]).columns
+                    yield chunk[columns].fillna(0).infer_objects()
+            finally:
+                for table in temp.values():
+                    drop_temp(cursor, table)
 
 
 class TradeDateReader(SQLSingleReader):
@@ -90,39 +152,116 @@ class SQLDailyReader(DailyReader):
         return self.reader(None, fields, **filters)
 
 
-class IndexConsReader(SQLSingleReader):
+class IntervalReader(SQLSingleReader):
 
-     def __call__(self, index=None, fields=None, **filters):
-        d1 = super(IndexConsReader, self).__call__(index=None, fields=fields, **filters)
-        if "out_date" in filters:
-            filters["out_date"] = None
-        else:
-            return d1
-        d2 = super(IndexConsReader, self).__call__(index=None, fields=fields, **filters)
-        return pd.concat([d1, d2], ignore_index=True)
+    # 区间结束字段, 为NULL代表区间尚未结束
+    end_key = None
+
+    def __call__(self, index=None, fields=None, **filters):
+        if filters.get(self.end_key, None) is not None:
+            filters[self.end_key] = OrNull(filters[self.end_key])
+        return super(IntervalReader, self).__call__(index=None, fields=fields, **filters)
+
+
+class IndexConsReader(IntervalReader):
+
+    end_key = "out_date"
     
 
-class SecSuspReader(SQLSingleReader):
+class SecSuspReader(IntervalReader):
 
-     def __call__(self, index=None, fields=None, **filters):
-        d1 = super(SecSuspReader, self).__call__(index=None, fields=fields, **filters)
-        if "resu_date" in filters:
-            filters["resu_date"] = None
-        else:
-            return d1
-        d2 = super(SecSuspReader, self).__call__(index=None, fields=fields, **filters)
-        return pd.concat([d1, d2], ignore_index=True)
+    end_key = "resu_date"
     
 
-def create_external(conn, mapper):
-    external = {}
+class LazySQLReader(SingleReader):
+
+    def __init__(self, conn, table, mapper=None, limits=None, **options):
+        """
+        第一次使用时才创建SQLSingleReader
+
+        :param options: 传给SQLSingleReader的in_threshold, string_type
+        """
+        self.conn = conn
+        self.table = table
+        self.mapper = mapper
+        self.columns = limits
+        self.options = options
+        self.lock = RLock()
+        self._reader = None
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            with self.lock:
+                if self._reader is None:
+                    self._reader = SQLSingleReader(self.conn, self.table, self.mapper, self.columns, **self.options)
+        return self._reader
+
+    def __call__(self, index=None, fields=None, **filters):
+        return self.reader(index, fields, **filters)
+
+    def predefine(self):
+        return self.reader.predefine()
+
+    def __getattr__(self, item):
+        if item.startswith("_") or item == "reader":
+            raise AttributeError(item)
+        return getattr(self.reader, item)
+
+
+def table_versions(conn):
+    """所有表及视图的最后修改时间: {schema.table: modify_date}"""
+    cmd = "select s.name as TABLE_SCHEMA, o.name as TABLE_NAME, o.modify_date as MODIFY_DATE " \
+          "from sys.objects o join sys.schemas s on o.schema_id = s.schema_id where o.type in ('U', 'V')"
+    with conn.checkout() as con:
+        data = pd.read_sql(cmd, con)
+    return dict(zip(data.TABLE_SCHEMA + "." + data.TABLE_NAME, data.MODIFY_DATE.astype(str)))
+
+
+def fetch_columns(conn):
+    """一次查询所有表的字段: {schema.table: [column]}"""
+    cmd = "select TABLE_SCHEMA,TABLE_NAME,COLUMN_NAME from information_schema.columns"
+    with conn.checkout() as con:
+        data = pd.read_sql(cmd, con)
+    columns = {}
+    for table, column in zip(data.TABLE_SCHEMA + "." + data.TABLE_NAME, data.COLUMN_NAME):
+        columns.setdefault(table, []).append(column)
+    return columns
+
+
+def load_schema(conn, path=None):
+    """
+    读取所有表的字段, path不为None时缓存到本地, 表的修改时间与缓存一致时直接使用缓存。
+
+    :return: dict: {schema.table: [column]}
+    """
+    versions = table_versions(conn) if path else None
+    if path and os.path.isfile(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached["versions"] == versions:
+                return cached["columns"]
+        except Exception as e:
+            logging.error("mssql schema cache | %s | %s", path, e)
+
+    columns = fetch_columns(conn)
+    if path:
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"versions": versions, "columns": columns}, f)
+        os.replace(tmp, path)
+    return columns
+
+
+def create_external(conn, mapper, schema=None, **options):
+    if schema is None:
+        schema = load_schema(conn)
+    return {
+        table: LazySQLReader(conn, table, mapper.get(table, {}), columns, **options)
+        for table, columns in schema.items()
+    }
 
-    tables = pd.read_sql("select TABLE_SCHEMA,TABLE_NAME from information_schema.TABLES", conn.connection())
-    for table in (tables.TABLE_SCHEMA + "." + tables.TABLE_NAME):
-        external[table] = SQLSingleReader(conn, table, mapper.get(table, {}))
-    return external
-    # return {table: SQLSingleReader(conn, table) for table in (tables.TABLE_SCHEMA + "." + tables.TABLE_NAME)}
-        
 
 SPECIAL_CLS = {
     "jz.secTradeCal": TradeDateReader,
@@ -133,20 +272,130 @@ SPECIAL_CLS = {
 
 
 class MSSQKConControler(object):
-    
+
     def __init__(self, *args , **kwargs):
+        """
+        线程安全的pymssql连接池, with self.checkout() as con: 借出一个连接, 退出时归还。
+
+        :param args: 传给pymssql.connect的参数
+        :param kwargs: 传给pymssql.connect的参数, 以下为连接池参数:
+            - min_size: int, 空闲回收时至少保留的连接数
+            - max_size: int, 同时打开的连接数上限
+            - max_idle: int | float, 空闲超过该秒数的连接被关闭
+            - wait_timeout: int | float, 连接数已满时等待归还的秒数, None代表一直等待
+        """
+        self.min_size = kwargs.pop("min_size", 1)
+        self.max_size = kwargs.pop("max_size", 8)
+        self.max_idle = kwargs.pop("max_idle", 300)
+        self.wait_timeout = kwargs.pop("wait_timeout", 30)
         self.args = args
         self.kwargs = kwargs
         self._con = None
-    
-    def __enter__(self):
-        self._con = pymssql.connect(*self.args, **self.kwargs)
-        return self._con
+        self.cond = Condition()
+        self.idle = deque()
+        self.size = 0
+        self.metrics = dict.fromkeys(
+            ["checkouts", "waits", "wait_seconds", "max_wait", "created", "evicted", "broken"], 0
+        )
+
+    @contextmanager
+    def checkout(self):
+        """每次借出的连接由各自的with语句归还, 多个生成器交替使用时互不影响"""
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release(con)
+
+    def connect(self):
+        con = pymssql.connect(*self.args, **self.kwargs)
+        with self.cond:
+            self.metrics["created"] += 1
+        return con
+
+    @staticmethod
+    def alive(con):
+        try:
+            cursor = con.cursor()
+            cursor.execute("select 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        start = time()
+        con = None
+        with self.cond:
+            self._evict()
+            while True:
+                if self.idle:
+                    con = self.idle.pop()[0]
+                    break
+                elif self.size < self.max_size:
+                    self.size += 1
+                    break
+                waited = time() - start
+                if self.wait_timeout is not None and waited >= self.wait_timeout:
+                    raise RuntimeError("MSSQL connection pool exhausted after %.1fs, max_size=%s" % (waited, self.max_size))
+                self.cond.wait(None if self.wait_timeout is None else self.wait_timeout - waited)
+            waited = time() - start
+            self.metrics["checkouts"] += 1
+            if waited > 0.001:
+                self.metrics["waits"] += 1
+                self.metrics["wait_seconds"] += waited
+                self.metrics["max_wait"] = max(self.metrics["max_wait"], waited)
+
+        if con is not None:
+            if self.alive(con):
+                return con
+            self._close(con)
+            with self.cond:
+                self.metrics["broken"] += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, con):
+        try:
+            con.rollback()
+        except Exception:
+            self._close(con)
+            with self.cond:
+                self.size -= 1
+                self.metrics["broken"] += 1
+                self.cond.notify()
+            return
+        with self.cond:
+            self.idle.append((con, time()))
+            self.cond.notify()
+
+    def _evict(self):
+        expire = time() - self.max_idle
+        while self.idle and self.size > self.min_size and self.idle[0][1] < expire:
+            self._close(self.idle.popleft()[0])
+            self.size -= 1
+            self.metrics["evicted"] += 1
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.metrics)
+            stats["size"] = self.size
+            stats["idle"] = len(self.idle)
+            return stats
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._con.close()
-        self._con = None
-    
     def connection(self):
         if self._con is not None:
             return self._con
@@ -155,9 +404,15 @@ class MSSQKConControler(object):
             return self._con
 
     def close(self):
+        """关闭connection()创建的连接及池中所有空闲连接, 已借出的连接归还后仍可复用"""
         if self._con is not None:
-            self._con.close
+            self._close(self._con)
         self._con = None
+        with self.cond:
+            while self.idle:
+                self._close(self.idle.pop()[0])
+                self.size -= 1
+            self.cond.notify_all()
 
 
 def load_conf(dct):
@@ -166,30 +421,32 @@ def load_conf(dct):
 
     methods = {}
     cp = dct["connection_params"]
-    conn = MSSQKConControler(*cp)
+    conn = MSSQKConControler(*cp, **dct.get("pool", {}))
+    options = {key: dct[key] for key in ("in_threshold", "string_type") if key in dct}
     db_map = dct["db_map"]
     if 'map_file' in dct:
         fields_map = read(dct["map_file"])
     else:
         fields_map = {}
+    schema = load_schema(conn, dct.get("schema_cache", None))
     for method, table in db_map.items():
         if len(table) == 0:
             continue
         cls = SPECIAL_CLS.get(method, SQLSingleReader)
         mapper = fields_map.get(table, {})
         if issubclass(cls, SingleMapReader):
-            methods[method] = cls(conn, table, mapper)
+            methods[method] = cls(conn, table, mapper, schema.get(table, None), **options)
         else:
-            methods[method] = cls(SQLSingleReader(conn, table, mapper))
+            methods[method] = cls(SQLSingleReader(conn, table, mapper, schema.get(table, None), **options))
     if dct.get("external", False):
         # methods["external"] = create_external(conn, fields_map)
-        methods.update(create_external(conn, fields_map))
+        methods.update(create_external(conn, fields_map, schema, **options))
     
     if dct.get("predefine", False):
         predefine = {}
         for key, method in methods.items():
             view = view_map.get(key, key)
-            if not isinstance(method, SQLSingleReader):
+            if not isinstance(method, (SQLSingleReader, LazySQLReader)):
                 if hasattr(method, "reader"):
                     method = method.reader
                 else:
@@ -201,7 +458,6 @@ def load_conf(dct):
         for name in dct.get("exclude", []):
             predefine.pop(name, None)
         methods["predefine"] = predefine
-    conn.close()
     return methods
 
 
@@ -216,5 +472,5 @@ def main():
 if __name__ == '__main__':
     # main()
     cc = MSSQKConControler()
-    with cc as c:
+    with cc.checkout() as c:
         print(c)
\ No newline at end of file
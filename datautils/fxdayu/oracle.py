@@ -3,6 +3,12 @@ import pandas as pd
 from datautils.fxdayu.basic import SingleReader, MultiReader, SingleMapReader
 from datetime import datetime
 # from datautils.sql import make_command
+from datautils.sql import build_query, split_filters
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
+import numbers
+import numpy as np
+from functools import reduce
 import logging
 
 
@@ -73,9 +79,19 @@ class OracleSingleReader(SingleMapReader):
     DTYPE = "PROCESSEDTYPE"
     DEFAULT_DTYPE = "A" 
 
-    def __init__(self, conn, db):
+    # 同时查询的字段表数量上限
+    workers = 8
+
+    def __init__(self, conn, db, pool=None, workers=None):
+        """
+        :param conn: cx_Oracle.Connection
+        :param pool: cx_Oracle.SessionPool, 不为None时各字段表并发查询, 每个线程从中借用连接
+        """
         self.conn = conn
         self.db = db
+        self.pool = pool
+        if workers is not None:
+            self.workers = workers
     
     def get_tables(self):
         command = make_command("ALL_TABLES", ["TABLE_NAME"], OWNER=self.db)
@@ -85,16 +101,52 @@ class OracleSingleReader(SingleMapReader):
     def read(self, fields=None, **filters):
         if fields is None:
             fields = self.get_tables()
-        cursor = self.conn.cursor()
-        dct = dict(self._iter_read(cursor, fields, filters))
-        return pd.DataFrame(dct).reset_index()
-    
+        elif isinstance(fields, str):
+            fields = [fields]
+        fields = list(fields)
+        if self.pool is not None and len(fields) > 1:
+            results = list(self._iter_concurrent(fields, filters))
+        else:
+            results = list(self._iter_read(self.conn.cursor(), fields, filters))
+        return self.merge(results)
+
+    def merge(self, results):
+        """按(SYMBOL, DATE)排序合并各字段, 每个字段为一列并保留各自的dtype"""
+        if len(results) == 0:
+            return pd.DataFrame(columns=self.INDEX)
+        indexes = [series.index for field, series in results if len(series)]
+        if len(indexes):
+            index = reduce(lambda left, right: left.union(right), indexes).sort_values()
+        else:
+            index = pd.MultiIndex.from_arrays([[], []], names=self.INDEX)
+        data = pd.DataFrame(index=index)
+        # 查询成功但没有数据的字段保留为全空列
+        for field, series in results:
+            data[field] = series.reindex(index) if len(series) else np.nan
+        return data.reset_index()
+
     def _iter_read(self, cursor, fields, filters):
         for field in fields :     
             try: 
                 yield field, self._read(cursor, field, **filters)
             except Exception as e:
                 logging.error("read Oracle | %s | %s | %s | %s", self.db, field, filters, e)
+
+    def _iter_concurrent(self, fields, filters):
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(fields))) as executor:
+            futures = [(field, executor.submit(self._pooled_read, field, dict(filters))) for field in fields]
+            for field, future in futures:
+                try:
+                    yield field, future.result()
+                except Exception as e:
+                    logging.error("read Oracle | %s | %s | %s | %s", self.db, field, filters, e)
+
+    def _pooled_read(self, field, filters):
+        conn = self.pool.acquire()
+        try:
+            return self._read(conn.cursor(), field, **filters)
+        finally:
+            self.pool.release(conn)
                 
 
     def _read(self, cursor, field, **filters):
@@ -117,27 +169,106 @@ class OracleSingleReader(SingleMapReader):
         return [self.SYMBOL, self.DATE]
 
 
+FILTER_TABLE = "DATAUTILS_FILTER"
+
+FILTER_TABLE_DDL = "create global temporary table %s " \
+                   "(NAME VARCHAR2(128), VALUE VARCHAR2(512), NUM NUMBER, DT DATE) on commit preserve rows"
+
+
+def create_filter_table(conn, name=FILTER_TABLE):
+    """
+    建立OracalTableReader使用的临时表, 部署时执行一次, 需要建表权限:
+
+        python -c "import cx_Oracle; from datautils.fxdayu.oracle import create_filter_table; \
+                   create_filter_table(cx_Oracle.Connection('user/password@dsn'))"
+    """
+    conn.cursor().execute(FILTER_TABLE_DDL % name)
+
+
+_session_lock = RLock()
+_session_locks = {}
+
+
+def session_lock(conn):
+    """同一连接(会话)共享临时表, 使用同一连接的reader共用一个锁"""
+    with _session_lock:
+        return _session_locks.setdefault(id(conn), RLock())
+
+
+def filter_column(values):
+    """按值的类型选择临时表中保存的列, 其他类型以字符串保存"""
+    if all([isinstance(value, datetime) for value in values]):
+        return "DT"
+    elif all([isinstance(value, numbers.Real) and not isinstance(value, bool) for value in values]):
+        return "NUM"
+    else:
+        return "VALUE"
+
+
 class OracalTableReader(SingleMapReader):
+    """
+    IN筛选的元素个数超过in_threshold时, 将筛选值写入会话级临时表(FILTER_TABLE)再以子查询筛选。
+    临时表需预先用create_filter_table建立。
+    """
 
-    def __init__(self, conn, table):
+    # IN筛选的元素个数超过该值时改为写入临时表筛选, None代表不使用临时表
+    # Oracle的IN列表最多1000个元素
+    in_threshold = 512
+    temp_table = FILTER_TABLE
+
+    def __init__(self, conn, table, mapper=None, in_threshold=in_threshold):
+        super(OracalTableReader, self).__init__(mapper)
         self.conn = conn
         self.table = table
-    
+        self.in_threshold = in_threshold
+        self.lock = session_lock(conn)
+
     def read(self, fields=None, **filters):
         if isinstance(fields, str):
             fields = {fields}
-        command = make_command(self.table, fields, **filters)
-        return pd.read_sql(command, self.conn)
+        filters, large = split_filters(filters, self.in_threshold)
+        if not large:
+            command = make_command(self.table, fields, **filters)
+            return pd.read_sql(command, self.conn)
+
+        columns = {key: filter_column(values) for key, values in large.items()}
+        subqueries = {
+            key: "select %s from %s where NAME = '%s'" % (column, self.temp_table, key)
+            for key, column in columns.items()
+        }
+        slots = {"VALUE": 1, "NUM": 2, "DT": 3}
+        rows = []
+        for key, values in large.items():
+            for value in values:
+                row = [key, None, None, None]
+                row[slots[columns[key]]] = str(value) if columns[key] == "VALUE" else value
+                rows.append(tuple(row))
+        command, params = build_query(self.table, fields, filters, "numeric", subqueries)
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute("delete from %s" % self.temp_table)
+                cursor.executemany(
+                    "insert into %s (NAME, VALUE, NUM, DT) values (:1, :2, :3, :4)" % self.temp_table, rows
+                )
+                return pd.read_sql(command, self.conn, params=params)
+            finally:
+                cursor.execute("delete from %s" % self.temp_table)
+                self.conn.commit()
 
 
 def load_conf(dct):
     r = {}
     url = dct["url"]
+    options = {"in_threshold": dct["in_threshold"]} if "in_threshold" in dct else {}
     connection =  cx_Oracle.Connection(url)
+    pool = create_pool(url, **dct["pool"]) if "pool" in dct else None
+    for api, table in dct.get("tables", {}).items():
+        r[api] = OracalTableReader(connection, table, **options)
     for api, conf in dct.get("api", {}).items():
         db = conf["db"]
         ReaderCls = get_reader_cls(api, conf)
-        reader = ReaderCls(connection, db)
+        reader = ReaderCls(connection, db, pool, dct.get("workers", None))
         r[api] = reader
         if conf.get("predefine", False):
             r.setdefault("predefine", {})[api] = reader.get_tables
@@ -145,6 +276,15 @@ def load_conf(dct):
     return r
 
 
+def create_pool(url, min=1, max=8, increment=1):
+    """
+    :param url: str, user/password@dsn
+    """
+    user, rest = url.split("/", 1)
+    password, dsn = rest.rsplit("@", 1)
+    return cx_Oracle.SessionPool(user, password, dsn, min=min, max=max, increment=increment, threaded=True)
+
+
 def get_reader_cls(name, dct):
     fields_map = dct.get("fields_map", FIELDS_MAP)
     table_structure = dct.get("table_structure", {})
@@ -1,7 +1,5 @@
 from datautils.fxdayu.basic import SingleMapReader
-import pandas as pd
-from datautils.sql import make_command
-import sqlite3
+from datautils.sql import build_query, split_filters, concat, SqliteConnection
 import numpy as np
 import logging
 import os
@@ -9,10 +7,15 @@ import os
 
 class LocalSqlite(SingleMapReader):
 
-    def __init__(self, sqlite_file, table, view="", mapper=None):
+    # IN筛选的元素个数超过该值时改为写入临时表筛选, None代表不使用临时表
+    in_threshold = 512
+
+    def __init__(self, sqlite_file, table, view="", mapper=None, conn=None, in_threshold=in_threshold):
         super(LocalSqlite, self).__init__(mapper)
         assert os.path.isfile(sqlite_file)
         self.file = sqlite_file
+        self.in_threshold = in_threshold
+        self.conn = conn if conn is not None else SqliteConnection(sqlite_file)
         self.table = table
         self.view = view
         self.columns = self.get_columns()
@@ -29,21 +32,23 @@ class LocalSqlite(SingleMapReader):
         return self._predefine
         
     def get_columns(self):
-        conn = sqlite3.Connection(self.file)
-        cursor = conn.cursor()
-        cursor.execute("select * from %s" % self.table)
-        return set([record[0] for record in cursor.description])
+        return self.conn.columns(self.table)
 
     def read(self, fields=None, **filters):
+        return concat(self.iter_read(fields, **filters))
+
+    def iter_read(self, fields=None, chunk_size=50000, **filters):
+        """分块读取, 每块最多chunk_size行"""
         if fields is not None:
             if isinstance(fields, str):
                 fields = {fields}
             fields = self.columns.intersection(set(fields))
-        command = make_command(self.table, fields, **filters)
-        conn = sqlite3.Connection(self.file)
-        r = pd.read_sql(command, conn)
-        conn.close()
-        return r
+        filters, large = split_filters(filters, self.in_threshold)
+        names = {key: self.conn.temp_name() for key in large}
+        temp = {names[key]: large[key] for key in large}
+        subqueries = {key: "select value from %s" % name for key, name in names.items()}
+        command, params = build_query(self.table, fields, filters, "qmark", subqueries)
+        return self.conn.iter_read(command, params, temp, chunk_size)
 
 
 def load_conf(dct):
@@ -54,11 +59,13 @@ def load_conf(dct):
         fields_map = {}
         
     sqlite_file = dct["file"]
+    conn = SqliteConnection(sqlite_file)
+    options = {"in_threshold": dct["in_threshold"]} if "in_threshold" in dct else {}
     methods = {}
     
     for key, table in dct.get("table_map", {}).items():
         mapper = fields_map.get(key, {})
-        reader = LocalSqlite(sqlite_file, table, key, mapper)
+        reader = LocalSqlite(sqlite_file, table, key, mapper, conn, **options)
         methods[key] = reader
         methods.setdefault("predefine", {})[key] = reader.predefine
     return methods
@@ -1,15 +1,51 @@
 from pymongo import InsertOne, UpdateOne
 from pymongo.cursor import CursorType
-from collections import Iterable
+from pymongo.errors import BulkWriteError
+from bson import decode_all, Binary
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from collections import Iterable, OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import logging
+import zlib
+from datautils.tools.frame import fill_dtype, clear
+from datetime import datetime
 import pandas as pd
+import numpy as np
 import six
 
 
-def iter_insert(data):
+def iter_records(data, dropna=True):
+    """
+    按列生成每一行的dict, 不经过iterrows。
+
+    :param data: pandas.DataFrame
+    :param dropna: bool, 是否去除每行中的空值
+    """
+    columns = list(data.columns)
+    values = [data[name].tolist() for name in columns]
+    if not dropna:
+        for row in zip(*values):
+            yield dict(zip(columns, row))
+        return
+    masks = [data[name].notnull().values.tolist() for name in columns]
+    for row, mask in zip(zip(*values), zip(*masks)):
+        yield {name: value for name, value, valid in zip(columns, row, mask) if valid}
+
+
+def index_names(data):
+    if isinstance(data.index, pd.MultiIndex):
+        return list(data.index.names)
+    else:
+        return [data.index.name if data.index.name is not None else "index"]
+
+
+def iter_insert(data, dropna=True):
     if data.index.name is not None or isinstance(data.index, pd.MultiIndex):
         data = data.reset_index()
-    for key, values in data.iterrows():
-        yield make_insert(values)
+    for record in iter_records(data, dropna):
+        yield InsertOne(record)
 
 
 def make_insert(series):
@@ -17,35 +53,116 @@ def make_insert(series):
     return InsertOne(dct)
 
 
-def insert(collection, data):
-    if data.index.name is not None:
-        data = data.reset_index()
+def insert(collection, data, batch_size=1000, workers=1, errors="raise"):
+    reports = bulk_write(collection, iter_insert(data, False), batch_size, workers, errors)
+    return sum([report["inserted"] for report in reports])
 
-    result = collection.insert_many(data.to_dict("records"))
-    return len(result.inserted_ids)
 
-
-def iter_update(data, **kwargs):
+def iter_update(data, how="$set", upsert=True, **kwargs):
     if isinstance(data, pd.DataFrame):
-        if isinstance(data.index, pd.MultiIndex):
-            for key, values in data.reset_index().iterrows():
-                yield make_update(values, data.index.names, **kwargs)
-        else:
-            for key, values in data.reset_index().iterrows():
-                yield make_update(values, [data.index.name], **kwargs)
+        index = index_names(data)
+        data = data.reset_index()
+        keys = [data[name].tolist() for name in index]
+        for key, record in zip(zip(*keys), iter_records(data)):
+            yield UpdateOne(dict(zip(index, key)), {how: record}, upsert=upsert)
 
 
 def make_update(series, index, how="$set", upsert=True, **kwargs):
     return UpdateOne({i: series[i] for i in index}, {how: series.dropna().to_dict()}, upsert=upsert)
 
 
-def update(collection, data, **kwargs):
-    result = collection.bulk_write(list(iter_update(data, **kwargs)))
-    return result.matched_count, result.upserted_count
-
-
-def append(collection, data):
-    return update(collection, data, how='$setOnInsert')
+def update(collection, data, batch_size=1000, workers=1, errors="raise", **kwargs):
+    reports = bulk_write(collection, iter_update(data, **kwargs), batch_size, workers, errors)
+    return sum([report["matched"] for report in reports]), sum([report["upserted"] for report in reports])
+
+
+def append(collection, data, batch_size=1000, workers=1, errors="raise"):
+    return update(collection, data, batch_size, workers, errors, how='$setOnInsert')
+
+
+def iter_batches(operations, batch_size):
+    operations = iter(operations)
+    while True:
+        batch = list(islice(operations, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def write_batch(collection, number, batch):
+    start = time()
+    report = {"batch": number, "count": len(batch), "errors": 0}
+    try:
+        result = collection.bulk_write(batch, ordered=False)
+    except BulkWriteError as e:
+        details = e.details
+        report.update({
+            "inserted": details.get("nInserted", 0),
+            "matched": details.get("nMatched", 0),
+            "modified": details.get("nModified", 0),
+            "upserted": details.get("nUpserted", 0),
+            "errors": len(details.get("writeErrors", [])),
+            "write_errors": details.get("writeErrors", [])
+        })
+        logging.error("bulk write | %s | batch %s | %s errors | %s",
+                      collection.full_name, number, report["errors"], details.get("writeErrors", [])[:1])
+    else:
+        report.update({
+            "inserted": result.inserted_count,
+            "matched": result.matched_count,
+            "modified": result.modified_count,
+            "upserted": result.upserted_count
+        })
+    report["seconds"] = time() - start
+    logging.info("bulk write | %s | %s", collection.full_name, report)
+    return report
+
+
+def bulk_write(collection, operations, batch_size=1000, workers=1, errors="raise"):
+    """
+    将写操作按batch_size分批, 以ordered=False发送, 可多线程并发。
+    同时在途的batch数量不超过workers*2, 内存中不会同时保存所有操作。
+
+    :param operations: Iterable, pymongo写操作
+    :param errors: "raise" | "log", raise时所有批次写完后若有写入错误则抛出BulkWriteError, log时只记录日志
+    :return: list of dict, 每批的数量, 写入结果计数, 错误数及耗时
+    """
+    batches = iter_batches(operations, batch_size)
+    if workers <= 1:
+        reports = [write_batch(collection, number, batch) for number, batch in enumerate(batches)]
+    else:
+        reports = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for number, batch in enumerate(batches):
+                pending.append(executor.submit(write_batch, collection, number, batch))
+                if len(pending) >= workers * 2:
+                    reports.append(pending.popleft().result())
+            while pending:
+                reports.append(pending.popleft().result())
+    if errors == "raise":
+        raise_errors(reports)
+    return reports
+
+
+def raise_errors(reports):
+    """
+    将各批的写入错误合并为一个BulkWriteError抛出, details["reports"]为全部批次的报告。
+    """
+    failed = [report for report in reports if report["errors"]]
+    if len(failed) == 0:
+        return
+    raise BulkWriteError({
+        "nInserted": sum([report.get("inserted", 0) for report in reports]),
+        "nMatched": sum([report.get("matched", 0) for report in reports]),
+        "nModified": sum([report.get("modified", 0) for report in reports]),
+        "nUpserted": sum([report.get("upserted", 0) for report in reports]),
+        "nRemoved": 0,
+        "upserted": [],
+        "writeErrors": [error for report in failed for error in report["write_errors"]],
+        "writeConcernErrors": [],
+        "reports": reports
+    })
 
 
 METHODS = {"insert": iter_insert,
@@ -102,39 +219,234 @@ def projection(index=None, fields=None):
     return prj
 
 
+def decode_batches(batches, codec_options=None):
+    """
+    将find_raw_batches返回的BSON批次逐批解码为DataFrame, 最后合并。
+    同一时间只保留一个批次的dict, 峰值内存远小于先解码全部文档再生成DataFrame。
+
+    :param batches: Iterable, 每个元素为多个BSON文档拼接的bytes
+    :param codec_options: bson.codec_options.CodecOptions
+    :return: pandas.DataFrame
+    """
+    if codec_options is None:
+        codec_options = DEFAULT_CODEC_OPTIONS
+    frames = []
+    for batch in batches:
+        docs = decode_all(batch, codec_options)
+        if len(docs):
+            frames.append(pd.DataFrame(docs))
+    if len(frames) == 0:
+        return pd.DataFrame()
+    elif len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
 def read(collection, index=None, fields=None, hint=None, **filters):
     filters = parser(**filters)
     prj = projection(index, fields)
-    cursor = collection.find(filters, prj, cursor_type=CursorType.EXHAUST)
+    cursor = collection.find_raw_batches(filters, prj, cursor_type=CursorType.EXHAUST)
     if hint is not None:
         cursor.hint(hint)
-    data = pd.DataFrame(list(cursor))
+    data = decode_batches(cursor, collection.codec_options)
     if index:
         return data.set_index(index)
     else:
         return data
 
 
-def make_chunk(data, params):
+def encode_column(values, compress=None):
+    """
+    将数值或时间列编码为二进制: {"b": bytes, "dtype": str, "shape": list, "z": 压缩方式}
+
+    :return: dict, 无法编码的类型(如字符串)返回None
+    """
+    values = np.ascontiguousarray(values)
+    if values.dtype.kind == "M":
+        values = values.astype("datetime64[ns]")
+    elif values.dtype.kind not in "biuf":
+        return None
+    raw = values.tobytes()
+    doc = {"dtype": values.dtype.str, "shape": list(values.shape)}
+    if compress == "zlib":
+        raw = zlib.compress(raw)
+        doc["z"] = compress
+    elif compress is not None:
+        raise ValueError("Unsupported chunk compression: %s" % compress)
+    doc["b"] = Binary(raw)
+    return doc
+
+
+def decode_column(value):
+    """解码encode_column生成的二进制列, 未压缩时np.frombuffer不复制数据, list编码的列原样返回。"""
+    if isinstance(value, dict) and "b" in value:
+        raw = value["b"]
+        if value.get("z", None) == "zlib":
+            raw = zlib.decompress(raw)
+        return np.frombuffer(raw, np.dtype(value["dtype"])).reshape(value["shape"])
+    else:
+        return value
+
+
+def make_chunk(data, params, binary=False, compress=None, time_key="datetime"):
+    """
+    :param binary: bool, 是否将数值与时间列保存为二进制
+    :param compress: str, 二进制列的压缩方式, None 或 "zlib"
+    :param time_key: str, 时间列, 始终以list保存, 供服务端按日内时间截取
+    """
     length = len(data.index)
-    dct = data.to_dict("list")
+    if binary:
+        dct = {}
+        for name in data.columns:
+            if name == time_key:
+                dct[name] = data[name].tolist()
+                continue
+            encoded = encode_column(data[name].values, compress)
+            dct[name] = encoded if encoded is not None else data[name].tolist()
+    else:
+        dct = data.to_dict("list")
     dct["_l"] = length
     dct.update(params)
     return dct
 
 
-def insert_chunk(collection, data, params):
-    chunk = make_chunk(data, params)
+def insert_chunk(collection, data, params, binary=False, compress=None, time_key="datetime"):
+    chunk = make_chunk(data, params, binary, compress, time_key)
     return collection.insert_one(chunk).inserted_id
 
 
-def update_chunk(collection, data, key, params, upsert=True, how="$set"):
-    chunk = make_chunk(data, **params)
-    result = collection.update_one(key, {how: chunk}, upser=upsert)
+def update_chunk(collection, data, key, params, upsert=True, how="$set", binary=False, compress=None,
+                 time_key="datetime"):
+    chunk = make_chunk(data, params, binary, compress, time_key)
+    result = collection.update_one(key, {how: chunk}, upsert=upsert)
     return {"upserted_id": result.upserted_id, "modified_count": result.modified_count}
 
 
-import numpy as np
+def iter_day_chunks(data, by="symbol", time_key="datetime"):
+    """
+    将多日多品种的数据按(by, 日期)切分
+
+    :return: Iterable, (by的值, 当日0点的datetime, 不含by列的DataFrame)
+    """
+    if time_key not in data.columns and data.index.name == time_key:
+        data = data.reset_index()
+    data = data.sort_values([by, time_key], kind="mergesort")
+    names = data[by].values
+    days = data[time_key].values.astype("datetime64[D]")
+    change = np.flatnonzero((names[1:] != names[:-1]) | (days[1:] != days[:-1])) + 1
+    bounds = np.concatenate([[0], change, [len(data)]])
+    columns = [name for name in data.columns if name != by]
+    data = data[columns]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        day = pd.Timestamp(days[start]).to_pydatetime()
+        yield names[start], day, data.iloc[start:end]
+
+
+def write_chunks(db, data, by="symbol", time_key="datetime", name=None, batch_size=100, workers=4,
+                 binary=False, compress=None, errors="raise"):
+    """
+    将多日多品种的bar数据按品种写入不同collection, 每个品种每天一个chunk, 以_d为key upsert。
+
+    :param db: pymongo.database.Database
+    :param data: pandas.DataFrame, 包含by和time_key列
+    :param name: callable, 由by的值得到collection名, None代表直接使用
+    :param errors: "raise" | "log", 同bulk_write
+    :return: list of dict, 各批写入的报告, 包含collection名
+    """
+    def write(collection_name, operations):
+        reports = bulk_write(db[collection_name], operations, batch_size, errors="log")
+        for report in reports:
+            report["collection"] = collection_name
+        return reports
+
+    def iter_tasks():
+        operations, current = [], None
+        for key, day, frame in iter_day_chunks(data, by, time_key):
+            collection_name = name(key) if name is not None else key
+            if collection_name != current and len(operations):
+                yield current, operations
+                operations = []
+            current = collection_name
+            chunk = make_chunk(frame, {"_d": day}, binary, compress, time_key)
+            operations.append(UpdateOne({"_d": day}, {"$set": chunk}, upsert=True))
+        if len(operations):
+            yield current, operations
+
+    reports = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for collection_name, operations in iter_tasks():
+            pending.append(executor.submit(write, collection_name, operations))
+            if len(pending) >= workers * 2:
+                reports.extend(pending.popleft().result())
+        while pending:
+            reports.extend(pending.popleft().result())
+    if errors == "raise":
+        raise_errors(reports)
+    return reports
+
+
+def chunk_values(line, dtype=None):
+    if dtype is not None and dtype.kind == "M":
+        return np.asarray(line, dtype)
+    values = np.asarray(line)
+    if values.dtype == object and len(values) and isinstance(values[0], datetime):
+        return np.asarray(line, "datetime64[ns]")
+    return values
+
+
+def assemble_chunks(docs, columns):
+    """
+    将chunk文档拼接为DataFrame。
+    先汇总各chunk的_l并为每一列预分配数组, dtype由第一个包含该列的chunk推断, 再按slice填充。
+
+    :param docs: list, chunk文档
+    :param columns: list, 需要读取的列
+    :return: pandas.DataFrame
+    """
+    lengths = np.array([doc["_l"] for doc in docs], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    total = int(offsets[-1])
+
+    dct = OrderedDict()
+    for name in columns:
+        lines = [decode_column(doc.get(name, None)) for doc in docs]
+        found, missing = None, False
+        for line, length in zip(lines, lengths):
+            if line is not None and len(line) == length:
+                if found is None and length:
+                    found = chunk_values(line)
+            elif length:
+                missing = True
+        dtype = found.dtype if found is not None else np.dtype(np.float64)
+        if dtype.kind in "USO":
+            dtype = np.dtype(object)
+        elif missing:
+            dtype = fill_dtype(dtype)
+
+        values = np.empty(total, dtype)
+        for i, line in enumerate(lines):
+            start, end = offsets[i], offsets[i+1]
+            if start == end:
+                continue
+            if line is None or len(line) != end - start:
+                clear(values[start:end])
+                continue
+            chunk = chunk_values(line, values.dtype)
+            if chunk.dtype != values.dtype and not np.can_cast(chunk.dtype, values.dtype):
+                values = upcast(values, chunk.dtype)
+            values[start:end] = chunk
+        dct[name] = values
+    return pd.DataFrame(dct)
+
+
+def upcast(values, dtype):
+    try:
+        return values.astype(np.result_type(values.dtype, dtype))
+    except TypeError:
+        return values.astype(object)
 
 
 def read_chunk(collection, filters, fields, index=None, **kwargs):
@@ -142,18 +454,96 @@ def read_chunk(collection, filters, fields, index=None, **kwargs):
     columns = list(prj.keys())
     columns.remove("_id")
     prj["_l"] = 1
-    cursor = collection.find(filters, prj, **kwargs)
+    docs = list(collection.find(filters, prj, **kwargs))
+    data = assemble_chunks(docs, columns)
+    return data.set_index(index) if index else data
 
-    dct = {name: [] for name in columns}
-    for doc in cursor:
-        length = doc["_l"]
-        for name in columns:
-            line = doc.get(name, [])
-            if len(line) == length:
-                dct[name].extend(line)
-            else:
-                dct[name].extend([np.NaN]*length)
 
-    data = pd.DataFrame(dct)
+def clock(value):
+    return {"$add": [
+        {"$multiply": [{"$hour": value}, 10000]},
+        {"$multiply": [{"$minute": value}, 100]},
+        {"$second": value}
+    ]}
+
+
+def window_pipeline(filters, prj, time_key, start=None, end=None):
+    """
+    生成按日内时间截取chunk的aggregate管道。
+    chunk内的bar按时间排序, 满足 start <= HHMMSS <= end 的bar是连续的一段,
+    服务端计算该段的起点与长度后用$slice截取, 只有需要的bar会被传输。
+
+    :param time_key: str, chunk中保存时间的列
+    :param start: int, HHMMSS, None代表不限
+    :param end: int, HHMMSS, None代表不限
+    """
+    columns = [name for name in prj if name != "_id"]
+    conditions = []
+    moment = {"$arrayElemAt": ["$%s" % time_key, "$$i"]}
+    if start is not None:
+        conditions.append({"$gte": [clock(moment), start]})
+    if end is not None:
+        conditions.append({"$lte": [clock(moment), end]})
+    # 时间列为二进制编码时(旧版本写入的chunk)不在服务端截取, _w为null, 返回整个chunk
+    positions = {"$cond": [
+        {"$isArray": "$%s" % time_key},
+        {"$filter": {"input": {"$range": [0, "$_l"]}, "as": "i", "cond": {"$and": conditions}}},
+        None
+    ]}
+    offset = {"$ifNull": [{"$arrayElemAt": ["$_w", 0]}, 0]}
+    count = {"$cond": [{"$isArray": "$_w"}, {"$size": "$_w"}, "$_l"]}
+
+    keep = dict(prj)
+    keep.update({"_l": 1, "_d": 1, time_key: 1})
+    # 二进制编码的列无法在服务端截取, 返回起点_o后在本地截取
+    sliced = {"_id": 0, "_l": count, "_o": offset}
+    for name in columns:
+        field = "$%s" % name
+        sliced[name] = {"$cond": [{"$isArray": field}, {"$slice": [field, offset, {"$max": [count, 1]}]}, field]}
+    return [
+        {"$match": filters},
+        {"$sort": {"_d": 1}},
+        {"$project": keep},
+        {"$addFields": {"_w": positions}},
+        {"$project": sliced}
+    ]
+
+
+def hhmmss(values):
+    values = np.asarray(values, "datetime64[s]")
+    seconds = (values - values.astype("datetime64[D]")).astype(np.int64)
+    return seconds // 3600 * 10000 + seconds % 3600 // 60 * 100 + seconds % 60
+
+
+def clip_window(doc, columns, time_key, start=None, end=None):
+    """在本地按日内时间截取整个返回的chunk"""
+    moments = hhmmss(doc[time_key])
+    mask = np.ones(len(moments), dtype=bool)
+    if start is not None:
+        mask &= moments >= start
+    if end is not None:
+        mask &= moments <= end
+    for name in columns:
+        line = doc.get(name, None)
+        if line is not None and len(line) == doc["_l"]:
+            doc[name] = line[mask] if isinstance(line, np.ndarray) else [item for item, keep in zip(line, mask) if keep]
+    doc["_l"] = int(mask.sum())
+
+
+def read_chunk_window(collection, filters, fields, index=None, time_key="datetime", start=None, end=None, **kwargs):
+    prj = projection(index, fields)
+    prj[time_key] = 1
+    columns = [name for name in prj if name != "_id"]
+    if start is None and end is None:
+        return read_chunk(collection, filters, fields, index, **kwargs)
+    docs = list(collection.aggregate(window_pipeline(filters, prj, time_key, start, end), **kwargs))
+    for doc in docs:
+        local = isinstance(doc.get(time_key, None), dict)
+        for name in columns:
+            value = doc.get(name, None)
+            if isinstance(value, dict):
+                doc[name] = decode_column(value)[doc["_o"]:doc["_o"]+doc["_l"]]
+        if local:
+            clip_window(doc, columns, time_key, start, end)
+    data = assemble_chunks(docs, columns)
     return data.set_index(index) if index else data
-
@@ -1,7 +1,9 @@
-from datautils.mongodb import read, parser, projection, parse_range, read_chunk
+from datautils.mongodb import read, parser, projection, parse_range, read_chunk, read_chunk_window, decode_batches
 from datautils.fxdayu.basic import SingleReader, MultiReader
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock, Thread
+from time import time
 import logging
-import pandas as pd
 import six
 
 
@@ -30,8 +32,13 @@ class IndexColReader(ColReader):
 
 class DBReader(MultiReader):
 
-    def __init__(self, db):
+    # 同时读取的collection数量上限, 各线程共享MongoClient的连接池
+    workers = 8
+
+    def __init__(self, db, workers=None):
         self.db = db
+        if workers is not None:
+            self.workers = workers
 
     def __call__(self, names, index=None, fields=None, **filters):
         return dict(self.iter_read(names, index, fields, **filters))
@@ -39,18 +46,32 @@ class DBReader(MultiReader):
     def iter_read(self, names, index=None, fields=None, **filters):
         filters = parser(**filters)
         prj = projection(index, fields)
-        for name in names:
-            try:
-                yield name, self._read(name, index, filters, prj)
-            except Exception as e:
-                logging.error("%s | %s | %s | %s | %s", name, index, filters, prj, e)
+        if isinstance(names, six.string_types):
+            names = [names]
+        else:
+            names = list(names)
+        if self.workers <= 1 or len(names) <= 1:
+            for name in names:
+                try:
+                    yield name, self._read(name, index, filters, prj)
+                except Exception as e:
+                    logging.error("%s | %s | %s | %s | %s", name, index, filters, prj, e)
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(names))) as executor:
+            futures = [(name, executor.submit(self._read, name, index, filters, prj)) for name in names]
+            for name, future in futures:
+                try:
+                    yield name, future.result()
+                except Exception as e:
+                    logging.error("%s | %s | %s | %s | %s", name, index, filters, prj, e)
 
     def get_col(self, name):
         return self.db[name]
 
     def _read(self, name, index, filters, prj):
-        cursor = self.get_col(name).find(filters, prj)
-        data = pd.DataFrame(list(cursor))
+        collection = self.get_col(name)
+        data = decode_batches(collection.find_raw_batches(filters, prj), collection.codec_options)
         if index is not None:
             if index in data.columns:
                 return data.set_index(index)
@@ -61,20 +82,97 @@ class DBReader(MultiReader):
             return data
 
 
+class CollectionCatalog(object):
+
+    # 缓存的collection列表有效秒数, 过期后在后台刷新, 刷新完成前继续使用旧列表
+    ttl = 600
+
+    _lock = RLock()
+    _shared = {}
+
+    def __init__(self, db, ttl=None):
+        self.db = db
+        if ttl is not None:
+            self.ttl = ttl
+        self.lock = RLock()
+        self._names = None
+        self.loaded = 0
+        self.refreshing = False
+
+    @classmethod
+    def of(cls, db):
+        """同一MongoClient下同名database共享一个catalog"""
+        key = (id(db.client), db.name)
+        with cls._lock:
+            catalog = cls._shared.get(key, None)
+            if catalog is None:
+                catalog = cls(db)
+                cls._shared[key] = catalog
+            return catalog
+
+    def names(self):
+        with self.lock:
+            if self._names is None:
+                self.load()
+            elif self.ttl is not None and time() - self.loaded > self.ttl and not self.refreshing:
+                self.refreshing = True
+                Thread(target=self.refresh, daemon=True).start()
+            return self._names
+
+    def load(self):
+        names = frozenset(self.db.list_collection_names())
+        with self.lock:
+            self._names = names
+            self.loaded = time()
+
+    def refresh(self):
+        try:
+            self.load()
+        except Exception as e:
+            logging.error("collection catalog | %s | %s", self.db.name, e)
+        finally:
+            self.refreshing = False
+
+    def lookup(self, name):
+        """缓存中没有时单独查询该collection是否存在"""
+        if name in self.names():
+            return True
+        if len(self.db.list_collection_names(filter={"name": name})) == 0:
+            return False
+        with self.lock:
+            self._names = self._names | {name}
+        return True
+
+
 class MultiDBReader(DBReader):
 
-    def __init__(self, dbs):
-        super(MultiDBReader, self).__init__(dbs)
+    def __init__(self, dbs, workers=None):
+        super(MultiDBReader, self).__init__(dbs, workers)
         self.dbs = {db.name: db for db in dbs}
-        self.col_map = {}
-        for db in self.db:
-            self.col_map.update(dict.fromkeys(db.collection_names(), db))
+        self.catalogs = [CollectionCatalog.of(db) for db in dbs]
 
     def get_col(self, name):
-        return self.col_map[name][name]
+        for catalog in self.catalogs:
+            if name in catalog.names():
+                return catalog.db[name]
+        for catalog in self.catalogs:
+            if catalog.lookup(name):
+                return catalog.db[name]
+        raise KeyError(name)
 
 
 class ChunkDBReader(DBReader):
 
     def _read(self, name, index, filters, prj):
         return read_chunk(self.get_col(name), filters, prj, index)
+
+    def read_window(self, name, index=None, fields=None, window=(None, None), **filters):
+        """
+        读取单个collection, 只返回日内时间在window内的bar。
+
+        :param window: tuple, (start, end), HHMMSS格式的整数
+        """
+        filters = parser(**filters)
+        prj = projection(index, fields)
+        start, end = window
+        return read_chunk_window(self.get_col(name), filters, prj, index, index, start, end)
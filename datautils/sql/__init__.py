@@ -1,3 +1,11 @@
+from datetime import datetime, date
+from threading import RLock
+from contextlib import contextmanager
+from itertools import count
+import pandas as pd
+import numpy as np
+import numbers
+import sqlite3
 
 
 def make_command(name, fields, **filters):
@@ -29,4 +37,242 @@ def iter_filters(**filters):
                 value = "'%s'" % value
             yield "%s = %s" % (key, value)
         else:
-            yield "%s is NULL" % key
\ No newline at end of file
+            yield "%s is NULL" % key
+
+
+PLACEHOLDERS = {
+    "qmark": lambda i: "?",
+    "format": lambda i: "%s",
+    "numeric": lambda i: ":%d" % i,
+    "mssql": lambda i: "@P%d" % i
+}
+
+
+def padded(values):
+    """将IN的参数个数补齐到2的幂, 使不同长度的列表共用少数几条语句"""
+    if len(values) == 0:
+        return values
+    size = 1
+    while size < len(values):
+        size *= 2
+    return values + [values[-1]] * (size - len(values))
+
+
+def make_query(name, fields, paramstyle="qmark", **filters):
+    """
+    生成参数化查询, 相同的字段和筛选结构总是生成相同的语句, 以便数据库复用执行计划。
+
+    :param paramstyle: str, 占位符格式, PLACEHOLDERS中的一种
+    :return: (str, tuple), 查询语句和参数
+    """
+    return build_query(name, fields, filters, paramstyle)
+
+
+def build_query(name, fields, filters, paramstyle="qmark", subqueries=None):
+    """
+    :param subqueries: dict: {key: 子查询语句}, 对应字段以 key in (子查询) 筛选
+    """
+    template = "select %s from %s"
+    fields = ",".join(sorted(fields)) if fields else "*"
+    command = template % (fields, name)
+    placeholder = PLACEHOLDERS[paramstyle]
+    conditions, params = [], []
+    for key in sorted(filters):
+        for condition, values in iter_params(key, filters[key]):
+            marks = [placeholder(len(params) + i + 1) for i in range(len(values))]
+            conditions.append(condition % tuple(marks) if marks else condition)
+            params.extend([value.item() if isinstance(value, np.generic) else value for value in values])
+    if subqueries:
+        for key in sorted(subqueries):
+            conditions.append("%s in (%s)" % (key, subqueries[key]))
+    if conditions:
+        command = "%s where %s" % (command, " and ".join(conditions))
+    return command, tuple(params)
+
+
+def split_filters(filters, threshold=None):
+    """
+    将元素个数超过threshold的IN筛选分离出来, 改由临时表筛选。
+
+    :return: (dict, dict), 其余的筛选条件和 {key: list}
+    """
+    if threshold is None:
+        return filters, {}
+    small, large = {}, {}
+    for key, value in filters.items():
+        if isinstance(value, (set, list)) and len(value) > threshold:
+            large[key] = [item.item() if isinstance(item, np.generic) else item for item in value]
+        else:
+            small[key] = value
+    return small, large
+
+
+class OrNull(object):
+
+    def __init__(self, value):
+        """筛选条件, 满足value或字段为NULL的都返回"""
+        self.value = value
+
+    def __repr__(self):
+        return "OrNull(%r)" % (self.value,)
+
+
+def iter_params(key, value):
+    if isinstance(value, OrNull):
+        parts = list(iter_params(key, value.value))
+        if len(parts):
+            yield "((%s) or %s is NULL)" % (" and ".join([part[0] for part in parts]), key), \
+                [item for part in parts for item in part[1]]
+    elif isinstance(value, (set, list)):
+        try:
+            values = padded(sorted(value))
+        except TypeError:
+            values = padded(list(value))
+        if len(values) == 0:
+            yield "1 = 0", []
+        elif len(values) == 1:
+            yield "%s = %%s" % key, values
+        else:
+            yield "%s in (%s)" % (key, ",".join(["%s"] * len(values))), values
+    elif isinstance(value, tuple):
+        start, end = value[0], value[1]
+        if start:
+            yield "%s >= %%s" % key, [start]
+        if end:
+            yield "%s <= %%s" % key, [end]
+    elif value is not None:
+        yield "%s = %%s" % key, [value]
+    else:
+        yield "%s is NULL" % key, []
+
+
+SQL_TYPES = [
+    (bool, "bit"),
+    (numbers.Integral, "bigint"),
+    (numbers.Real, "float"),
+    (datetime, "datetime2"),
+    (date, "date")
+]
+
+# 字符串参数的默认类型, 与varchar列比较时不会对列做隐式转换
+STRING_TYPE = "varchar(8000)"
+
+
+def sql_type(value, string_type=STRING_TYPE):
+    for cls, name in SQL_TYPES:
+        if isinstance(value, cls):
+            return name
+    return string_type
+
+
+def sp_executesql(command, params, string_type=STRING_TYPE):
+    """
+    将@P1格式的查询包装为sp_executesql调用, 使pymssql的查询在服务端参数化。
+
+    :param string_type: str, 字符串参数声明的类型, 应与被筛选列的类型一致(varchar或nvarchar)
+    :return: (str, tuple), 可直接传给pymssql cursor.execute的语句和参数
+    """
+    if len(params) == 0:
+        return command, None
+    declare = ", ".join(["@P%d %s" % (i + 1, sql_type(value, string_type)) for i, value in enumerate(params)])
+    assign = ", ".join(["@P%d=%%s" % (i + 1) for i in range(len(params))])
+    return "exec sp_executesql N'%s', N'%s', %s" % (
+        command.replace("'", "''").replace("%", "%%"), declare, assign
+    ), params
+
+
+def iter_cursor(cursor, chunk_size=50000):
+    """
+    用fetchmany分块读取已执行的cursor, 至少返回一个DataFrame(可能为空)。
+    """
+    columns = [record[0] for record in cursor.description]
+    first = True
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0 and not first:
+            break
+        first = False
+        yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        if len(rows) < chunk_size:
+            break
+
+
+def concat(chunks):
+    chunks = list(chunks)
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks, ignore_index=True)
+
+
+class SqliteConnection(object):
+
+    def __init__(self, file, cached_statements=256, max_idle=4):
+        """
+        sqlite连接池, 每次读取独占一个连接, 读取结束后归还并保持打开以复用sqlite3的语句缓存。
+        多个线程或交替迭代的iter_read各自使用不同的连接。
+
+        :param max_idle: int, 归还后保留的空闲连接数上限
+        """
+        self.file = file
+        self.cached_statements = cached_statements
+        self.max_idle = max_idle
+        self.lock = RLock()
+        self.idle = []
+        self.counter = count()
+
+    def connect(self):
+        return sqlite3.connect(self.file, check_same_thread=False, cached_statements=self.cached_statements)
+
+    @contextmanager
+    def checkout(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = self.connect()
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def temp_name(self):
+        """每次查询使用不重复的临时表名"""
+        return "_filter%d" % next(self.counter)
+
+    def columns(self, table):
+        with self.checkout() as conn:
+            cursor = conn.execute("select * from %s limit 0" % table)
+            return set([record[0] for record in cursor.description])
+
+    def read(self, command, params=(), temp=None):
+        """
+        :param temp: dict: {临时表名: list}, 查询前写入单列(value)临时表, 查询后删除
+        """
+        return concat(self.iter_read(command, params, temp))
+
+    def iter_read(self, command, params=(), temp=None, chunk_size=50000):
+        """分块读取, 迭代结束前独占一个连接"""
+        temp = temp or {}
+        with self.checkout() as conn:
+            try:
+                for table, values in temp.items():
+                    conn.execute("create temp table %s (value)" % table)
+                    conn.executemany("insert into %s values (?)" % table, [(value,) for value in values])
+                cursor = conn.execute(command, params)
+                try:
+                    for chunk in iter_cursor(cursor, chunk_size):
+                        yield chunk
+                finally:
+                    cursor.close()
+            finally:
+                for table in temp:
+                    conn.execute("drop table if exists temp.%s" % table)
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
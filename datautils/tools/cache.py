@@ -0,0 +1,171 @@
+from collections import OrderedDict, Iterable
+from inspect import signature
+from threading import RLock
+from time import time
+import pandas as pd
+import weakref
+import logging
+import sys
+
+
+_caches = weakref.WeakSet()
+
+
+def invalidate(*views):
+    """清除所有QueryCache中指定view的缓存, 供数据源发生变化时调用。"""
+    for cache in list(_caches):
+        cache.invalidate(*views)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return "dict", tuple(sorted([(key, freeze(item)) for key, item in value.items()], key=repr))
+    elif isinstance(value, tuple):
+        return "tuple", tuple([freeze(item) for item in value])
+    elif isinstance(value, list):
+        return "list", tuple([freeze(item) for item in value])
+    elif isinstance(value, (set, frozenset)):
+        return "set", tuple(sorted([freeze(item) for item in value], key=repr))
+    else:
+        hash(value)
+        return value
+
+
+def call_key(reader, args, kwargs):
+    """
+    按reader的签名绑定调用参数后冻结, 使等价的调用得到相同的key。
+    fields为列表等可迭代对象时不区分顺序。
+    """
+    try:
+        bound = signature(reader).bind(*args, **kwargs)
+    except (TypeError, ValueError):
+        return freeze(args), freeze(kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    fields = arguments.get("fields", None)
+    if isinstance(fields, Iterable) and not isinstance(fields, (str, bytes)):
+        arguments["fields"] = set(fields)
+    return freeze(arguments)
+
+
+def sizeof(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    elif isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    elif isinstance(value, dict):
+        return sys.getsizeof(value) + sum([sizeof(item) for item in value.values()])
+    else:
+        return sys.getsizeof(value)
+
+
+def copy(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    elif isinstance(value, dict):
+        return {key: copy(item) for key, item in value.items()}
+    else:
+        return value
+
+
+class QueryCache(object):
+
+    def __init__(self, max_bytes=256*1024*1024, ttl=300):
+        """
+        按字节数限制大小的LRU查询结果缓存
+
+        :param max_bytes: int, 缓存总大小上限
+        :param ttl: int | float, 每条缓存的有效秒数, None代表不过期
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        _caches.add(self)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[2] is not None and entry[2] < time():
+                self._pop(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, copy(entry[0])
+
+    def put(self, key, view, value):
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        expire = time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._pop(key)
+            self.entries[key] = (copy(value), size, expire, view)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _pop(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry[1]
+
+    def invalidate(self, *views):
+        views = set(views)
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[3] in views]:
+                self._pop(key)
+
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self.entries),
+                "bytes": self.size
+            }
+
+
+class CachedReader(object):
+
+    def __init__(self, reader, view, cache):
+        self.reader = reader
+        self.view = view
+        self.cache = cache
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = (self.view, call_key(self.reader, args, kwargs))
+        except TypeError:
+            return self.reader(*args, **kwargs)
+        hit, value = self.cache.get(key)
+        if hit:
+            return value
+        value = self.reader(*args, **kwargs)
+        try:
+            self.cache.put(key, self.view, value)
+        except Exception as e:
+            logging.error("query cache | %s | %s", self.view, e)
+        return value
+
+    def __getattr__(self, item):
+        if item == "reader":
+            raise AttributeError(item)
+        return getattr(self.reader, item)
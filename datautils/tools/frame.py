@@ -0,0 +1,116 @@
+import pandas as pd
+import numpy as np
+from functools import reduce
+from collections import OrderedDict
+
+
+def union(indexes):
+    indexes = [index for index in indexes if len(index)]
+    if len(indexes) == 0:
+        return pd.Index([])
+    return reduce(lambda left, right: left.union(right), indexes)
+
+
+def fill_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind in "biu":
+        return np.dtype(np.float64)
+    else:
+        return dtype
+
+
+def clear(block):
+    if block.dtype.kind == "M":
+        block.fill(np.datetime64("NaT"))
+    else:
+        block.fill(np.nan)
+
+
+def align(frame, index, columns):
+    return frame.index.equals(index) and frame.columns.equals(columns)
+
+
+def long_frame(block, major, minor, columns, major_name, minor_name):
+    """
+    将形如(columns, major * minor)的二维数组组装为长表, major在外层, minor在内层。
+
+    :param block: numpy.ndarray, 每一行对应一个字段
+    :return: pandas.DataFrame, columns: [major_name, minor_name] + columns
+    """
+    frame = pd.DataFrame(block.T, columns=pd.Index(columns), copy=False)
+    frame.insert(0, minor_name, np.tile(np.asarray(minor), len(major)))
+    frame.insert(0, major_name, np.repeat(np.asarray(major), len(minor)))
+    return frame
+
+
+def to_long(dct, major_name, minor_name):
+    """
+    替代 pd.Panel.from_dict(dct).to_frame(False).reset_index()
+
+    :param dct: {item: DataFrame(major x minor)}
+    :return: pandas.DataFrame, 每个item为一列, 只复制一次数据。
+    """
+    items = sorted(dct)
+    frames = [dct[item] for item in items]
+    major = union([frame.index for frame in frames])
+    minor = union([frame.columns for frame in frames])
+    filled = [frame for frame in frames if len(frame.index) and len(frame.columns)]
+    if len(filled):
+        dtype = np.result_type(*[frame.values.dtype for frame in filled])
+    else:
+        dtype = np.dtype(np.float64)
+    if not all([align(frame, major, minor) for frame in frames]):
+        dtype = fill_dtype(dtype)
+
+    block = np.empty((len(items), len(major), len(minor)), dtype)
+    for i, frame in enumerate(frames):
+        if align(frame, major, minor):
+            block[i] = frame.values
+        else:
+            clear(block[i])
+            rows = major.get_indexer(frame.index)
+            cols = minor.get_indexer(frame.columns)
+            block[i][np.ix_(rows, cols)] = frame.values
+    return long_frame(block.reshape(len(items), -1), major, minor, items, major_name, minor_name)
+
+
+def common_dtype(dtypes):
+    try:
+        return np.result_type(*dtypes)
+    except TypeError:
+        return np.dtype(object)
+
+
+def stack_items(dct, major_name, minor_name, rename=None):
+    """
+    替代 pd.Panel.from_dict(dct).transpose(2, 1, 0).to_frame(False).reset_index()
+
+    :param dct: {minor: DataFrame(major x columns)}, 非OrderedDict时按key排序
+    :param rename: callable, 对合并后的major索引做向量化转换, 结果作为major_name列
+    :return: pandas.DataFrame, columns: [major_name, minor_name] + columns
+    """
+    minor = list(dct) if isinstance(dct, OrderedDict) else sorted(dct)
+    frames = [dct[name] for name in minor]
+    major = union([frame.index for frame in frames])
+    columns = union([frame.columns for frame in frames])
+    rows = [major.get_indexer(frame.index) for frame in frames]
+
+    data = OrderedDict()
+    for column in columns:
+        present = [j for j, frame in enumerate(frames) if column in frame.columns]
+        dtype = common_dtype([frames[j][column].dtype for j in present])
+        full = len(present) == len(frames) and all([len(rows[j]) == len(major) for j in present])
+        if not full:
+            dtype = fill_dtype(dtype)
+        values = np.empty((len(major), len(minor)), dtype)
+        if not full:
+            clear(values)
+        for j in present:
+            values[rows[j], j] = frames[j][column].values
+        data[column] = values.ravel()
+
+    frame = pd.DataFrame(data, columns=columns)
+    major_values = rename(major) if rename is not None else major
+    frame.insert(0, minor_name, np.tile(np.asarray(minor, dtype=object), len(major)))
+    frame.insert(0, major_name, np.repeat(np.asarray(major_values), len(minor)))
+    return frame
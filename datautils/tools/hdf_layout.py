@@ -0,0 +1,178 @@
+import tables
+import numpy as np
+import pandas as pd
+import posixpath
+import logging
+import shutil
+import time
+import os
+
+
+LAYOUT = "LAYOUT"
+DATE_MAJOR = "date"
+SYMBOL_MAJOR = "symbol"
+
+
+def get_layout(node):
+    return getattr(node.attrs, LAYOUT, DATE_MAJOR)
+
+
+def chunk_shape(shape, date_block=1024, symbol_block=16):
+    """
+    symbol-major布局下/data的chunkshape: (symbol_block, date_block)
+
+    date_block越大, 单个symbol的历史越集中; symbol_block越小, 读少量symbol时额外读取的数据越少。
+    """
+    n_dates, n_symbols = shape
+    return max(min(symbol_block, n_symbols), 1), max(min(date_block, n_dates), 1)
+
+
+def copy_others(source, target, skip):
+    """
+    将source中除skip外的所有group, leaf及其属性原样复制到target。
+    """
+    source.root._v_attrs._f_copy(target.root)
+    for group in source.walk_groups("/"):
+        if group._v_pathname == "/":
+            continue
+        created = target.create_group(group._v_parent._v_pathname, group._v_name, createparents=True)
+        group._v_attrs._f_copy(created)
+    for leaf in source.walk_nodes("/", "Leaf"):
+        if leaf._v_pathname not in skip:
+            leaf._f_copy(target.get_node(leaf._v_parent._v_pathname))
+
+
+def convert(src, dst=None, date_block=1024, symbol_block=16, complib="blosc:lz4", complevel=5,
+            value_name="/data", index_names=("/date_flag", "/symbol_flag")):
+    """
+    将 (date x symbol) 布局的hdf文件改写为按chunk压缩的 (symbol x date) 布局, 其余节点与属性原样复制。
+
+    :param src: str, 原文件
+    :param dst: str, 目标文件, None时原地替换
+    :param index_names: (date轴节点, symbol轴节点), 用于校验value_name的形状
+    :return: bool, 是否进行了转换
+    """
+    if dst is None:
+        dst = src
+    tmp = dst + ".tmp"
+    with tables.File(src, "r") as source:
+        data = source.get_node(value_name)
+        if get_layout(data) == SYMBOL_MAJOR:
+            if os.path.abspath(src) != os.path.abspath(dst):
+                shutil.copyfile(src, dst)
+            return False
+        n_dates, n_symbols = data.shape
+        axes = tuple(source.get_node(name).shape[0] for name in index_names)
+        if axes != (n_dates, n_symbols):
+            raise ValueError("Shape of %s %s does not match %s %s" % (value_name, data.shape, index_names, axes))
+        with tables.File(tmp, "w") as target:
+            copy_others(source, target, {value_name})
+            where, node_name = posixpath.split(value_name)
+            out = target.create_carray(
+                where, node_name, tables.Atom.from_dtype(data.dtype), (n_symbols, n_dates),
+                filters=tables.Filters(complevel=complevel, complib=complib, shuffle=True),
+                chunkshape=chunk_shape(data.shape, date_block, symbol_block),
+                createparents=True
+            )
+            for start in range(0, n_dates, date_block):
+                out[:, start:start+date_block] = data[start:start+date_block].T
+            data._v_attrs._f_copy(out)
+            setattr(out.attrs, LAYOUT, SYMBOL_MAJOR)
+    os.replace(tmp, dst)
+    return True
+
+
+def benchmark(path, value_name="/data", symbols=5, repeat=3, seed=0):
+    """
+    读取速度测试
+
+    :return: dict: {"history": 随机symbols个symbol的全历史读取耗时, "cross": 单日全市场读取耗时}
+    """
+    rng = np.random.RandomState(seed)
+    with tables.File(path, "r") as f:
+        node = f.get_node(value_name)
+        symbol_major = get_layout(node) == SYMBOL_MAJOR
+        n_symbols, n_dates = node.shape if symbol_major else node.shape[::-1]
+        history, cross = [], []
+        for i in range(repeat):
+            cols = rng.randint(0, n_symbols, symbols)
+            start = time.time()
+            for col in cols:
+                if symbol_major:
+                    node[col, :]
+                else:
+                    node[:, col]
+            history.append(time.time() - start)
+
+            row = rng.randint(0, n_dates)
+            start = time.time()
+            if symbol_major:
+                node[:, row]
+            else:
+                node[row, :]
+            cross.append(time.time() - start)
+    return {"history": min(history), "cross": min(cross)}
+
+
+def convert_view(root, target=None, value_name="/data", **kwargs):
+    """
+    转换一个view目录下的所有.hd5文件并报告文件大小与读取速度的变化。
+
+    :param root: str, view目录
+    :param target: str, 输出目录, None时原地替换
+    :param kwargs: 传给convert的参数
+    :return: pandas.DataFrame, index为文件名
+    """
+    if target is not None and not os.path.isdir(target):
+        os.makedirs(target)
+    report = {}
+    for filename in sorted(os.listdir(root)):
+        if not filename.endswith(".hd5"):
+            continue
+        src = os.path.join(root, filename)
+        dst = os.path.join(target, filename) if target is not None else src
+        try:
+            before = benchmark(src, value_name)
+            size = os.path.getsize(src)
+            convert(src, dst, value_name=value_name, **kwargs)
+            after = benchmark(dst, value_name)
+        except Exception as e:
+            logging.error("convert hdf layout | %s | %s", src, e)
+            continue
+        report[filename] = {
+            "size_before": size,
+            "size_after": os.path.getsize(dst),
+            "history_before": before["history"],
+            "history_after": after["history"],
+            "cross_before": before["cross"],
+            "cross_after": after["cross"]
+        }
+        logging.warning("convert hdf layout | %s | %s", filename, report[filename])
+    return pd.DataFrame(report).T
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert HDF view files to symbol-major chunked layout.")
+    parser.add_argument("root")
+    parser.add_argument("--target", default=None)
+    parser.add_argument("--date-block", type=int, default=1024)
+    parser.add_argument("--symbol-block", type=int, default=16)
+    parser.add_argument("--complib", default="blosc:lz4")
+    parser.add_argument("--complevel", type=int, default=5)
+    parser.add_argument("--value", default="/data", help="value node, (date x symbol)")
+    parser.add_argument("--index", default="/date_flag", help="date axis node")
+    parser.add_argument("--column", default="/symbol_flag", help="symbol axis node")
+    args = parser.parse_args()
+    report = convert_view(
+        args.root, args.target, args.value,
+        date_block=args.date_block, symbol_block=args.symbol_block,
+        complib=args.complib, complevel=args.complevel,
+        index_names=(args.index, args.column)
+    )
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import unittest
+from unittest import mock
+import pandas as pd
+from datautils.tools import cache
+from datautils.tools.cache import QueryCache, CachedReader, freeze, invalidate
+from datautils.fxdayu.basic import SingleReader, DailyReader
+
+
+def frame(rows=10):
+    return pd.DataFrame({"close": [float(i) for i in range(rows)]})
+
+
+class TestFreeze(unittest.TestCase):
+
+    def test_equal_keys(self):
+        self.assertEqual(freeze({"a": [1, 2], "b": {3, 1}}), freeze({"b": {1, 3}, "a": [1, 2]}))
+        self.assertNotEqual(freeze([1, 2]), freeze((1, 2)))
+
+    def test_unhashable(self):
+        with self.assertRaises(TypeError):
+            freeze(bytearray(b"x"))
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_hit_returns_copy(self):
+        qc = QueryCache()
+        qc.put("k", "view", frame())
+        hit, value = qc.get("k")
+        self.assertTrue(hit)
+        value["close"] = 0
+        self.assertEqual(qc.get("k")[1]["close"].iloc[1], 1.0)
+        self.assertEqual(qc.get("missing"), (False, None))
+        self.assertEqual(qc.stats()["hits"], 2)
+        self.assertEqual(qc.stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        size = cache.sizeof(frame())
+        qc = QueryCache(max_bytes=size * 2)
+        qc.put("a", "view", frame())
+        qc.put("b", "view", frame())
+        qc.get("a")
+        qc.put("c", "view", frame())
+        self.assertTrue(qc.get("a")[0])
+        self.assertFalse(qc.get("b")[0])
+        self.assertEqual(qc.stats()["evictions"], 1)
+        self.assertLessEqual(qc.stats()["bytes"], size * 2)
+
+    def test_too_large(self):
+        qc = QueryCache(max_bytes=10)
+        qc.put("a", "view", frame())
+        self.assertEqual(qc.stats()["entries"], 0)
+
+    def test_ttl(self):
+        qc = QueryCache(ttl=5)
+        with mock.patch.object(cache, "time", return_value=100):
+            qc.put("a", "view", frame())
+        with mock.patch.object(cache, "time", return_value=104):
+            self.assertTrue(qc.get("a")[0])
+        with mock.patch.object(cache, "time", return_value=106):
+            self.assertFalse(qc.get("a")[0])
+        self.assertEqual(qc.stats()["expirations"], 1)
+        self.assertEqual(qc.stats()["bytes"], 0)
+
+    def test_invalidate(self):
+        qc = QueryCache()
+        qc.put("a", "daily", frame())
+        qc.put("b", "bar", frame())
+        invalidate("daily")
+        self.assertFalse(qc.get("a")[0])
+        self.assertTrue(qc.get("b")[0])
+
+
+class CountingReader(SingleReader):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, index=None, fields=None, **filters):
+        self.calls += 1
+        return frame()
+
+
+class CountingDaily(DailyReader):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, symbols, start, end, fields=None):
+        self.calls += 1
+        return frame()
+
+
+class TestCachedReader(unittest.TestCase):
+
+    def test_fields_order(self):
+        reader = CountingReader()
+        cached = CachedReader(reader, "daily", QueryCache())
+        cached(fields=["a", "b"], symbol="000001.SZ")
+        cached(fields=["b", "a"], symbol="000001.SZ")
+        cached(fields={"a", "b"}, symbol="000001.SZ")
+        self.assertEqual(reader.calls, 1)
+        cached(fields=["a"], symbol="000001.SZ")
+        self.assertEqual(reader.calls, 2)
+
+    def test_positional_and_keyword(self):
+        reader = CountingReader()
+        cached = CachedReader(reader, "daily", QueryCache())
+        cached(None, ["close"])
+        cached(fields=["close"])
+        cached(index=None, fields=["close"])
+        self.assertEqual(reader.calls, 1)
+        cached("symbol", ["close"])
+        self.assertEqual(reader.calls, 2)
+
+    def test_other_signature(self):
+        reader = CountingDaily()
+        cached = CachedReader(reader, "daily", QueryCache())
+        cached(["000001.SZ"], 20180101, 20180201, ["open", "close"])
+        cached(["000001.SZ"], 20180101, end=20180201, fields=["close", "open"])
+        self.assertEqual(reader.calls, 1)
+
+    def test_cached_call(self):
+        reader = mock.Mock(return_value=frame())
+        cached = CachedReader(reader, "daily", QueryCache())
+        first = cached(["000001.SZ"], fields={"close"}, start=20180101)
+        second = cached(["000001.SZ"], fields={"close"}, start=20180101)
+        reader.assert_called_once()
+        pd.testing.assert_frame_equal(first, second)
+        cached(["000002.SZ"], fields={"close"}, start=20180101)
+        self.assertEqual(reader.call_count, 2)
+
+    def test_unhashable_args_bypass(self):
+        reader = mock.Mock(return_value=frame())
+        cached = CachedReader(reader, "daily", QueryCache())
+        cached(bytearray(b"x"))
+        cached(bytearray(b"x"))
+        self.assertEqual(reader.call_count, 2)
+
+    def test_attributes(self):
+        reader = mock.Mock(return_value=frame(), fields=["close"])
+        self.assertEqual(CachedReader(reader, "daily", QueryCache()).fields, ["close"])
+
+
+if __name__ == '__main__':
+    unittest.main()
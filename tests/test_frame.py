@@ -0,0 +1,91 @@
+import unittest
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from datautils.tools.frame import stack_items, to_long
+from datautils.fxdayu.mongodb import BarDBReader
+
+
+def daily(dates, **columns):
+    return pd.DataFrame(columns, pd.DatetimeIndex(dates))
+
+
+class TestToLong(unittest.TestCase):
+
+    def test_aligned(self):
+        index, columns = [20180102, 20180103], ["a", "b"]
+        dct = {
+            "open": pd.DataFrame([[1, 2], [3, 4]], index, columns),
+            "close": pd.DataFrame([[5, 6], [7, 8]], index, columns),
+        }
+        frame = to_long(dct, "trade_date", "symbol")
+        self.assertEqual(list(frame.columns), ["trade_date", "symbol", "close", "open"])
+        self.assertEqual(list(frame["trade_date"]), [20180102, 20180102, 20180103, 20180103])
+        self.assertEqual(list(frame["symbol"]), ["a", "b", "a", "b"])
+        self.assertEqual(list(frame["open"]), [1, 2, 3, 4])
+        self.assertEqual(frame["close"].dtype, np.int64)
+
+    def test_unaligned(self):
+        dct = {
+            "open": pd.DataFrame([[1, 2]], [20180102], ["a", "b"]),
+            "close": pd.DataFrame([[5.5]], [20180103], ["b"]),
+        }
+        frame = to_long(dct, "trade_date", "symbol")
+        self.assertEqual(len(frame), 4)
+        np.testing.assert_array_equal(frame["open"].values, [1, 2, np.nan, np.nan])
+        np.testing.assert_array_equal(frame["close"].values, [np.nan, np.nan, np.nan, 5.5])
+
+    def test_empty(self):
+        frame = to_long({"open": pd.DataFrame()}, "trade_date", "symbol")
+        self.assertEqual(list(frame.columns), ["trade_date", "symbol", "open"])
+        self.assertTrue(frame.empty)
+
+
+class TestStackItems(unittest.TestCase):
+
+    def test_full(self):
+        dct = {
+            "b": daily(["2018-01-02", "2018-01-03"], close=[1.0, 2.0], volume=[10, 20]),
+            "a": daily(["2018-01-02", "2018-01-03"], close=[3.0, 4.0], volume=[30, 40]),
+        }
+        frame = stack_items(dct, "datetime", "symbol")
+        self.assertEqual(list(frame.columns), ["datetime", "symbol", "close", "volume"])
+        self.assertEqual(list(frame["symbol"]), ["a", "b", "a", "b"])
+        self.assertEqual(list(frame["close"]), [3.0, 1.0, 4.0, 2.0])
+        self.assertEqual(frame["volume"].dtype, np.int64)
+
+    def test_missing_rows_and_columns(self):
+        dct = OrderedDict([
+            ("b", daily(["2018-01-03"], close=[2.0], volume=[20])),
+            ("a", daily(["2018-01-02", "2018-01-03"], close=[3.0, 4.0])),
+        ])
+        frame = stack_items(dct, "datetime", "symbol")
+        self.assertEqual(list(frame["symbol"]), ["b", "a", "b", "a"])
+        np.testing.assert_array_equal(frame["close"].values, [np.nan, 3.0, 2.0, 4.0])
+        np.testing.assert_array_equal(frame["volume"].values, [np.nan, np.nan, 20, np.nan])
+        self.assertEqual(frame["volume"].dtype, np.float64)
+
+    def test_rename(self):
+        dct = {"a": daily(["2018-01-02", "2018-01-03"], close=[1.0, 2.0])}
+        frame = stack_items(dct, "trade_date", "symbol", lambda index: index.strftime("%Y%m%d"))
+        self.assertEqual(list(frame["trade_date"]), ["20180102", "20180103"])
+
+
+class TestBarOutput(unittest.TestCase):
+
+    def test_int64_date_time(self):
+        index = pd.DatetimeIndex(["2018-01-02 09:31", "2018-01-02 15:00"])
+        dct = {
+            "000001.XSHE": pd.DataFrame({"close": [1.0, 2.0]}, index),
+            "600000.XSHG": pd.DataFrame({"close": [3.0, 4.0]}, index),
+        }
+        frame = BarDBReader.__new__(BarDBReader).output(dct)
+        self.assertEqual(frame["time"].dtype, np.int64)
+        self.assertEqual(frame["trade_date"].dtype, np.int64)
+        self.assertEqual(list(frame["time"]), [93100, 93100, 150000, 150000])
+        self.assertEqual(list(frame["trade_date"]), [20180102] * 4)
+        self.assertEqual(list(frame["symbol"]), ["000001.SZ", "600000.SH"] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import tempfile
+import shutil
+import os
+from unittest import mock
+import numpy as np
+import tables
+from datautils.tools import hdf_layout
+from datautils.tools.hdf_layout import convert, get_layout, SYMBOL_MAJOR
+
+
+def write_view(path, data, index="/date_flag", column="/symbol_flag"):
+    with tables.File(path, "w") as f:
+        f.root._v_attrs.source = "test"
+        node = f.create_carray("/", "data", obj=data)
+        node.attrs.unit = "yuan"
+        f.create_array("/", index.lstrip("/"), np.arange(20000101, 20000101 + data.shape[0]).reshape(-1, 1))
+        f.create_array("/", column.lstrip("/"), np.arange(data.shape[1]).reshape(-1, 1))
+        extra = f.create_array("/meta", "fields", np.array([b"close"]), createparents=True)
+        extra.attrs.version = 2
+        f.get_node("/meta")._v_attrs.owner = "fxdayu"
+
+
+class TestConvert(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.src = os.path.join(self.root, "close.hd5")
+        self.dst = os.path.join(self.root, "out", "close.hd5")
+        self.data = np.random.RandomState(0).rand(50, 30)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_keeps_other_nodes_and_attrs(self):
+        write_view(self.src, self.data)
+        os.makedirs(os.path.dirname(self.dst))
+        self.assertTrue(convert(self.src, self.dst, date_block=16, symbol_block=4))
+        with tables.File(self.dst, "r") as f:
+            node = f.get_node("/data")
+            self.assertEqual(get_layout(node), SYMBOL_MAJOR)
+            self.assertEqual(node.attrs.unit, "yuan")
+            np.testing.assert_array_equal(node.read(), self.data.T)
+            self.assertEqual(f.root._v_attrs.source, "test")
+            self.assertEqual(f.get_node("/meta")._v_attrs.owner, "fxdayu")
+            self.assertEqual(f.get_node("/meta/fields").attrs.version, 2)
+            self.assertEqual(list(f.get_node("/meta/fields").read()), [b"close"])
+            self.assertEqual(f.get_node("/date_flag").shape, (50, 1))
+
+    def test_shape_mismatch(self):
+        write_view(self.src, self.data, "/trade_date", "/symbol")
+        with self.assertRaises(tables.NoSuchNodeError):
+            convert(self.src)
+        with self.assertRaises(ValueError):
+            convert(self.src, index_names=("/symbol", "/trade_date"))
+
+    def test_cli_renamed_axes(self):
+        write_view(self.src, self.data, "/trade_date", "/symbol")
+        argv = ["hdf_layout", self.root, "--index", "/trade_date", "--column", "/symbol"]
+        with mock.patch("sys.argv", argv), mock.patch("builtins.print"):
+            hdf_layout.main()
+        with tables.File(self.src, "r") as f:
+            self.assertEqual(get_layout(f.get_node("/data")), SYMBOL_MAJOR)
+            self.assertEqual(f.get_node("/trade_date").shape, (50, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
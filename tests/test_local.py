@@ -0,0 +1,173 @@
+import unittest
+import tempfile
+import shutil
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+import pandas as pd
+import tables
+from datautils.fxdayu.local import HDFStructure, HDFDaily
+from datautils.tools.hdf_layout import convert
+
+
+def write_hdf(path, data, filters=None):
+    with tables.File(path, "w") as f:
+        f.create_carray("/", "data", obj=data, filters=filters)
+        f.create_array("/", "date_flag", np.arange(20000101, 20000101 + data.shape[0]).reshape(-1, 1))
+        f.create_array("/", "symbol_flag", np.array([("%06d" % i).encode() for i in range(data.shape[1])]).reshape(-1, 1))
+
+
+REWRITE = """
+import sys
+import numpy as np
+import tables
+with tables.File(sys.argv[1], "w") as f:
+    f.create_carray("/", "data", obj=np.full((3, 2), 7.0))
+    f.create_array("/", "date_flag", np.arange(20000101, 20000104).reshape(-1, 1))
+    f.create_array("/", "symbol_flag", np.array([b"000000", b"000001"]).reshape(-1, 1))
+"""
+
+
+class CountingStructure(HDFStructure):
+
+    slabs = 0
+
+    def _slab(self, node, rows, cols):
+        self.slabs += 1
+        return super(CountingStructure, self)._slab(node, rows, cols)
+
+
+class TestRuns(unittest.TestCase):
+
+    def test_slice(self):
+        self.assertEqual(HDFStructure._runs(slice(2, 5)), ([(slice(2, 5), None)], None))
+
+    def test_contiguous(self):
+        runs, order = HDFStructure._runs(np.array([3, 4, 5]))
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0][0], slice(3, 6))
+        self.assertIsNone(runs[0][1])
+        self.assertIsNone(order)
+
+    def test_merge_gaps(self):
+        runs, order = HDFStructure._runs(np.array([1, 4, 100]), max_gap=2)
+        self.assertEqual([run[0] for run in runs], [slice(1, 5), slice(100, 101)])
+        np.testing.assert_array_equal(runs[0][1], [0, 3])
+        self.assertIsNone(runs[1][1])
+
+    def test_order(self):
+        runs, order = HDFStructure._runs(np.array([5, 1, 5, 3]), max_gap=10)
+        self.assertEqual([run[0] for run in runs], [slice(1, 6)])
+        np.testing.assert_array_equal(np.array([1, 3, 5])[order], [5, 1, 5, 3])
+
+    def test_empty(self):
+        self.assertEqual(HDFStructure._runs(np.array([], dtype=int)), ([(slice(0, 0), None)], None))
+
+
+class TestLoc(unittest.TestCase):
+
+    def test_iterable(self):
+        index = pd.Index([10, 20, 30])
+        loc, values = HDFStructure._loc(index, [30, 15, 10])
+        np.testing.assert_array_equal(loc, [2, 0])
+        self.assertEqual(list(values), [30, 10])
+
+    def test_scalar(self):
+        loc, values = HDFStructure._loc(pd.Index(["a", "b"]), "b")
+        np.testing.assert_array_equal(loc, [1])
+
+    def test_none(self):
+        loc, values = HDFStructure._loc(pd.Index([1, 2]), None)
+        self.assertEqual(loc, slice(None))
+
+
+class TestScatteredRead(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = np.random.RandomState(0).rand(300, 4000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check(self, filters):
+        path = os.path.join(self.root, "data.hd5")
+        write_hdf(path, self.data, filters)
+        structure = CountingStructure(path)
+        cols = np.random.RandomState(1).choice(4000, 300, replace=False)
+        rows = np.array([299, 0, 150])
+        try:
+            value = structure.value(rows, cols)
+        finally:
+            structure.pool.close()
+        np.testing.assert_array_equal(value, self.data[np.ix_(rows, cols)])
+        # 分散的位置应合并为少量hyperslab读取, 而非每个位置一次
+        self.assertLessEqual(structure.slabs, 2)
+
+    def test_plain(self):
+        self.check(None)
+
+    def test_compressed(self):
+        self.check(tables.Filters(5, "zlib"))
+
+    def test_symbol_major(self):
+        path = os.path.join(self.root, "data.hd5")
+        write_hdf(path, self.data)
+        convert(path, date_block=64, symbol_block=16)
+        structure = CountingStructure(path)
+        try:
+            value = structure.value(slice(None), np.array([400, 1]))
+            rows = structure.value(np.array([299, 0, 150]), np.array([5]))
+        finally:
+            structure.pool.close()
+        np.testing.assert_array_equal(value, self.data[:, [400, 1]])
+        np.testing.assert_array_equal(rows, self.data[[299, 0, 150]][:, [5]])
+        # 每个symbol单独读取, 不读入中间symbol的历史; 日期方向仍合并
+        self.assertEqual(structure.slabs, 3)
+
+    def test_far_apart(self):
+        path = os.path.join(self.root, "data.hd5")
+        write_hdf(path, self.data)
+        structure = CountingStructure(path)
+        structure.max_gap = 10
+        try:
+            value = structure.value(slice(None), np.array([3999, 0]))
+        finally:
+            structure.pool.close()
+        np.testing.assert_array_equal(value, self.data[:, [3999, 0]])
+        self.assertEqual(structure.slabs, 2)
+
+
+class TestFileRelease(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "high.hd5")
+        write_hdf(self.path, np.ones((3, 2)))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @staticmethod
+    def read(daily):
+        return daily.files["high"].read([20000101, 20000102, 20000103], None).values
+
+    def test_other_process_can_rewrite(self):
+        daily = HDFDaily(self.root, HDFStructure, "v", linger=0.05)
+        try:
+            self.assertEqual(self.read(daily).tolist(), [[1.0, 1.0]] * 3)
+            time.sleep(0.3)
+            # 句柄空闲后已关闭, 其他进程可以原地改写文件
+            result = subprocess.run([sys.executable, "-c", REWRITE, self.path], stderr=subprocess.PIPE)
+            self.assertEqual(result.returncode, 0, result.stderr.decode())
+            self.assertEqual(daily.sync(), {"high"})
+            self.assertEqual(self.read(daily).tolist(), [[7.0, 7.0]] * 3)
+        finally:
+            daily.executor.shutdown()
+            daily.pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
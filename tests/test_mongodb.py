@@ -0,0 +1,247 @@
+import unittest
+from unittest import mock
+from datetime import datetime
+import math
+import numpy as np
+import pandas as pd
+from bson import encode
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import datautils.mongodb as mongodb
+from datautils.fxdayu.mongodb import UpdateStatus
+from datautils.mongodb import iter_day_chunks, iter_batches, bulk_write, insert, update, decode_batches, make_chunk, encode_column, assemble_chunks, window_pipeline, \
+    read_chunk_window
+
+
+def raw_batches(docs, size):
+    return [b"".join([encode(doc) for doc in docs[i:i+size]]) for i in range(0, len(docs), size)]
+
+
+class TestDecodeBatches(unittest.TestCase):
+
+    def test_same_as_records(self):
+        docs = [{"symbol": "%06d" % i, "date": 20180101 + i, "close": (i if i % 2 else i + 0.5)} for i in range(10)]
+        result = decode_batches(raw_batches(docs, 3))
+        pd.testing.assert_frame_equal(result, pd.DataFrame(docs))
+        self.assertEqual(result["close"].dtype, np.float64)
+        self.assertEqual(result["date"].dtype, np.int64)
+
+    def test_missing_fields(self):
+        docs = [{"a": 1}, {"a": 2, "b": "x"}, {"b": "y"}, {"a": 4}]
+        result = decode_batches(raw_batches(docs, 2))
+        self.assertEqual(list(result.columns), ["a", "b"])
+        np.testing.assert_array_equal(result["a"].values, [1, 2, np.nan, 4])
+        self.assertEqual(list(result["b"].iloc[1:3]), ["x", "y"])
+
+    def test_empty(self):
+        self.assertTrue(decode_batches([]).empty)
+
+
+def bars(day="2018-01-02", times=("09:31", "09:32", "13:01", "15:00")):
+    return pd.DataFrame({
+        "datetime": pd.to_datetime(["%s %s" % (day, t) for t in times]),
+        "close": np.arange(len(times), dtype=np.float64) + 10,
+        "volume": np.arange(len(times), dtype=np.int64) * 100
+    })
+
+
+class FakeAggregate(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.pipelines = []
+
+    def aggregate(self, pipeline, **kwargs):
+        self.pipelines.append(pipeline)
+        return iter(self.docs)
+
+
+class TestIterDayChunks(unittest.TestCase):
+
+    def test_split(self):
+        data = pd.concat([
+            bars("2018-01-03").assign(symbol="b"),
+            bars("2018-01-02").assign(symbol="a"),
+            bars("2018-01-02").assign(symbol="b"),
+        ], ignore_index=True)
+        chunks = list(iter_day_chunks(data))
+        self.assertEqual([(name, day) for name, day, frame in chunks], [
+            ("a", datetime(2018, 1, 2)), ("b", datetime(2018, 1, 2)), ("b", datetime(2018, 1, 3))
+        ])
+        for name, day, frame in chunks:
+            self.assertEqual(list(frame.columns), ["datetime", "close", "volume"])
+            self.assertEqual(len(frame), 4)
+            self.assertTrue(frame["datetime"].is_monotonic_increasing)
+
+    def test_datetime_index(self):
+        data = bars().assign(symbol="a").iloc[::-1].set_index("datetime")
+        chunks = list(iter_day_chunks(data))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(list(chunks[0][2]["close"]), [10.0, 11.0, 12.0, 13.0])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_day_chunks(bars().assign(symbol="a").iloc[:0])), [])
+
+
+class TestBinaryChunk(unittest.TestCase):
+
+    def test_time_key_stays_list(self):
+        chunk = make_chunk(bars(), {"_d": datetime(2018, 1, 2)}, binary=True, compress="zlib")
+        self.assertIsInstance(chunk["datetime"], list)
+        self.assertIsInstance(chunk["close"], dict)
+        self.assertEqual(chunk["close"]["z"], "zlib")
+        self.assertEqual(chunk["_l"], 4)
+
+    def test_assemble_decodes_once(self):
+        data = bars()
+        chunk = make_chunk(data, {}, binary=True, compress="zlib")
+        decode = mock.Mock(side_effect=mongodb.decode_column)
+        with mock.patch.object(mongodb, "decode_column", decode):
+            result = assemble_chunks([chunk, chunk], ["close", "volume"])
+        self.assertEqual(decode.call_count, 4)
+        np.testing.assert_array_equal(result["close"].values, np.tile(data["close"].values, 2))
+        self.assertEqual(result["volume"].dtype, np.int64)
+
+    def test_window_guards_binary_time(self):
+        pipeline = window_pipeline({}, {"_id": 0, "close": 1, "datetime": 1}, "datetime", 93000, 113000)
+        positions = pipeline[3]["$addFields"]["_w"]
+        self.assertEqual(positions["$cond"][0], {"$isArray": "$datetime"})
+
+    def test_window_on_legacy_binary_time(self):
+        data = bars()
+        doc = {
+            "datetime": encode_column(data["datetime"].values),
+            "close": encode_column(data["close"].values),
+            "_l": 4,
+            "_o": 0
+        }
+        collection = FakeAggregate([doc])
+        result = read_chunk_window(collection, {}, ["close"], None, "datetime", 93000, 113000)
+        self.assertEqual(list(result["close"]), [10.0, 11.0])
+        self.assertEqual(list(result["datetime"]), list(data["datetime"][:2]))
+
+
+class FakeCollection(object):
+
+    full_name = "test.fake"
+
+    def __init__(self, fail=()):
+        self.batches = []
+        self.fail = set(fail)
+
+    def bulk_write(self, batch, ordered=True):
+        self.batches.append((list(batch), ordered))
+        number = len(self.batches) - 1
+        if number in self.fail:
+            raise BulkWriteError({"nInserted": len(batch) - 1, "writeErrors": [{"index": 0}]})
+        inserts = len([op for op in batch if isinstance(op, InsertOne)])
+        updates = len(batch) - inserts
+        return mock.Mock(inserted_count=inserts, matched_count=updates, modified_count=updates, upserted_count=0)
+
+
+class TestBulkWrite(unittest.TestCase):
+
+    def test_iter_batches(self):
+        self.assertEqual(list(iter_batches(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(iter_batches([], 2)), [])
+
+    def test_batches_unordered(self):
+        collection = FakeCollection()
+        reports = bulk_write(collection, (InsertOne({"i": i}) for i in range(25)), 10)
+        self.assertEqual([len(batch) for batch, ordered in collection.batches], [10, 10, 5])
+        self.assertFalse(any([ordered for batch, ordered in collection.batches]))
+        self.assertEqual([report["batch"] for report in reports], [0, 1, 2])
+        self.assertEqual(sum([report["inserted"] for report in reports]), 25)
+
+    def test_workers(self):
+        collection = FakeCollection()
+        reports = bulk_write(collection, (InsertOne({"i": i}) for i in range(95)), 10, workers=3)
+        self.assertEqual([report["batch"] for report in reports], list(range(10)))
+        self.assertEqual(sum([report["count"] for report in reports]), 95)
+
+    def test_errors_raise(self):
+        collection = FakeCollection(fail=[1])
+        with self.assertRaises(BulkWriteError) as context:
+            bulk_write(collection, (InsertOne({"i": i}) for i in range(9)), 3)
+        # 出错后仍写完其余批次, 再抛出包含全部报告的异常
+        self.assertEqual(len(collection.batches), 3)
+        details = context.exception.details
+        self.assertEqual(details["nInserted"], 8)
+        self.assertEqual(details["writeErrors"], [{"index": 0}])
+        self.assertEqual([report["errors"] for report in details["reports"]], [0, 1, 0])
+
+    def test_errors_log(self):
+        collection = FakeCollection(fail=[1])
+        reports = bulk_write(collection, (InsertOne({"i": i}) for i in range(6)), 3, errors="log")
+        self.assertEqual([report["errors"] for report in reports], [0, 1])
+        self.assertEqual(reports[1]["inserted"], 2)
+
+    def test_insert_raises(self):
+        data = pd.DataFrame({"close": [1.0, 2.0]})
+        with self.assertRaises(BulkWriteError):
+            insert(FakeCollection(fail=[0]), data)
+        self.assertEqual(insert(FakeCollection(fail=[0]), data, errors="log"), 1)
+
+    def test_insert_update(self):
+        data = pd.DataFrame({"symbol": ["a", "b"], "close": [1.0, np.nan]}).set_index("symbol")
+        collection = FakeCollection()
+        self.assertEqual(insert(collection, data), 2)
+        self.assertEqual(update(collection, data), (2, 0))
+        operation = collection.batches[1][0][1]
+        self.assertIsInstance(operation, UpdateOne)
+        self.assertEqual(operation._filter, {"symbol": "b"})
+
+
+class TestAssembleChunks(unittest.TestCase):
+
+    def test_plain(self):
+        docs = [
+            {"_l": 2, "close": [1.0, 2.0], "volume": [1, 2], "symbol": ["a", "a"]},
+            {"_l": 1, "close": [3.0], "volume": [3], "symbol": ["b"]},
+        ]
+        result = assemble_chunks(docs, ["close", "volume", "symbol"])
+        self.assertEqual(list(result.columns), ["close", "volume", "symbol"])
+        self.assertEqual(list(result["close"]), [1.0, 2.0, 3.0])
+        self.assertEqual(result["volume"].dtype, np.int64)
+        self.assertEqual(list(result["symbol"]), ["a", "a", "b"])
+
+    def test_missing_column(self):
+        docs = [{"_l": 2, "volume": [1, 2]}, {"_l": 1}, {"_l": 0, "volume": []}]
+        result = assemble_chunks(docs, ["volume", "close"])
+        np.testing.assert_array_equal(result["volume"].values, [1, 2, np.nan])
+        self.assertEqual(result["volume"].dtype, np.float64)
+        self.assertTrue(result["close"].isnull().all())
+
+    def test_upcast(self):
+        docs = [{"_l": 1, "volume": [1]}, {"_l": 2, "volume": [2.5, 3.5]}]
+        result = assemble_chunks(docs, ["volume"])
+        self.assertEqual(list(result["volume"]), [1.0, 2.5, 3.5])
+
+    def test_datetime(self):
+        times = [datetime(2018, 1, 2, 9, 31), datetime(2018, 1, 2, 9, 32)]
+        result = assemble_chunks([{"_l": 2, "datetime": times}], ["datetime"])
+        self.assertEqual(result["datetime"].dtype.kind, "M")
+        self.assertEqual(list(result["datetime"]), times)
+
+    def test_empty(self):
+        result = assemble_chunks([], ["close"])
+        self.assertEqual(list(result.columns), ["close"])
+        self.assertTrue(result.empty)
+
+
+class TestIndicatorStatus(unittest.TestCase):
+
+    def test_skip_nan(self):
+        collection = FakeAggregate([{"trade_date": 20180102, "status": 2.0}])
+        status = UpdateStatus.__new__(UpdateStatus)
+        status.daily_indicator = collection
+        result = status.indicator_status(20180101, 20180105)
+        self.assertEqual(result[20180102], 2.0)
+        product = collection.pipelines[0][1]["$project"]["status"]["$reduce"]
+        numeric = product["in"]["$cond"][0]["$and"][0]["$and"]
+        self.assertEqual(numeric[1]["$ne"][0], "$$this.v")
+        self.assertTrue(math.isnan(numeric[1]["$ne"][1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+from datautils.fxdayu.mssql import MSSQKConControler, SQLSingleReader, IndexConsReader, LazySQLReader
+from datautils.sql import OrNull
+
+
+class FakeCursor(object):
+
+    def __init__(self, con):
+        self.con = con
+        self.description = [("symbol",), ("close",)]
+        self.rows = []
+
+    def execute(self, command, params=None):
+        self.rows = list(self.con.rows)
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    rows = [("000001.SZ", 1.0), ("000002.SZ", 2.0), ("600000.SH", 3.0)]
+
+    def __init__(self):
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("pymssql.connect", side_effect=lambda *args, **kwargs: FakeConnection())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse(self):
+        pool = MSSQKConControler(max_size=2)
+        with pool.checkout() as first:
+            pass
+        with pool.checkout() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(pool.stats()["created"], 1)
+
+    def test_exhausted(self):
+        pool = MSSQKConControler(max_size=1, wait_timeout=0.05)
+        with pool.checkout():
+            with self.assertRaises(RuntimeError):
+                with pool.checkout():
+                    pass
+
+    def test_interleaved_checkouts(self):
+        pool = MSSQKConControler(max_size=4)
+        first = pool.checkout()
+        second = pool.checkout()
+        con1 = first.__enter__()
+        con2 = second.__enter__()
+        # 先借出的连接先归还, 不能影响后借出的连接
+        first.__exit__(None, None, None)
+        self.assertEqual([item[0] for item in pool.idle], [con1])
+        with pool.checkout() as con3:
+            self.assertIsNot(con3, con2)
+        second.__exit__(None, None, None)
+        self.assertEqual(pool.stats()["idle"], 2)
+
+    def test_interleaved_iter_read(self):
+        pool = MSSQKConControler(max_size=4)
+        reader = SQLSingleReader(pool, "lb.secDaily", {}, ["symbol", "close"])
+        first = reader.iter_read(chunk_size=1)
+        second = reader.iter_read(chunk_size=1)
+        next(first)
+        next(second)
+        self.assertEqual(sum([len(chunk) for chunk in first]), 2)
+        self.assertEqual(pool.stats()["idle"], 1)
+        self.assertEqual(sum([len(chunk) for chunk in second]), 2)
+        self.assertEqual(pool.stats()["idle"], 2)
+
+    def test_options_per_instance(self):
+        pool = MSSQKConControler(max_size=1)
+        reader = SQLSingleReader(pool, "lb.secDaily", {}, ["symbol"], in_threshold=None, string_type="nvarchar(4000)")
+        self.assertIsNone(reader.in_threshold)
+        self.assertEqual(reader.string_type, "nvarchar(4000)")
+        self.assertEqual(SQLSingleReader.in_threshold, 1024)
+        self.assertEqual(SQLSingleReader(pool, "lb.secDaily", {}, ["symbol"]).in_threshold, 1024)
+        lazy = LazySQLReader(pool, "lb.income", {}, ["symbol"], in_threshold=10)
+        self.assertEqual(lazy.reader.in_threshold, 10)
+
+
+class TestIntervalReader(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = IndexConsReader(None, "lb.indexCons", {}, ["symbol", "out_date"])
+        patcher = mock.patch.object(SQLSingleReader, "__call__", return_value="result")
+        self.call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_or_null(self):
+        self.assertEqual(self.reader(fields=["symbol"], out_date=(20180101, None)), "result")
+        self.call.assert_called_once()
+        out_date = self.call.call_args[1]["out_date"]
+        self.assertIsInstance(out_date, OrNull)
+        self.assertEqual(out_date.value, (20180101, None))
+
+    def test_no_end_filter(self):
+        self.reader(fields=["symbol"], symbol="000001.SZ")
+        self.call.assert_called_once_with(index=None, fields=["symbol"], symbol="000001.SZ")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from datautils.fxdayu.oracle import OracalTableReader, OracleSingleReader, load_conf
+
+
+class TestTableReader(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = mock.MagicMock()
+        self.cursor = self.conn.cursor.return_value
+        patcher = mock.patch("pandas.read_sql", return_value=pd.DataFrame({"CLOSE": [1.0]}))
+        self.read_sql = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shared_session_lock(self):
+        first = OracalTableReader(self.conn, "A")
+        second = OracalTableReader(self.conn, "B")
+        self.assertIs(first.lock, second.lock)
+        self.assertIsNot(first.lock, OracalTableReader(mock.MagicMock(), "C").lock)
+
+    def test_numeric_filter_uses_temp_table(self):
+        reader = OracalTableReader(self.conn, "ZYYX.STK")
+        reader.read(["CLOSE"], CODE=list(range(2000)))
+        command = self.read_sql.call_args[0][0]
+        self.assertIn("CODE in (select NUM from DATAUTILS_FILTER where NAME = 'CODE')", command)
+        rows = self.cursor.executemany.call_args[0][1]
+        self.assertEqual(len(rows), 2000)
+        self.assertEqual(rows[5], ("CODE", None, 5, None))
+        statements = [call[0][0] for call in self.cursor.execute.call_args_list]
+        self.assertFalse([statement for statement in statements if statement.startswith("create")])
+
+    def test_string_filter(self):
+        reader = OracalTableReader(self.conn, "ZYYX.STK")
+        reader.read(None, STOCK_CODE=["%06d" % i for i in range(600)], CON_DATE=(20180101, None))
+        command, = self.read_sql.call_args[0][:1]
+        self.assertIn("STOCK_CODE in (select VALUE from DATAUTILS_FILTER", command)
+        self.assertEqual(self.read_sql.call_args[1]["params"], (20180101,))
+
+
+    def test_conf_threshold_per_instance(self):
+        with mock.patch("datautils.fxdayu.oracle.cx_Oracle"):
+            methods = load_conf({"url": "u/p@dsn", "tables": {"stk": "ZYYX.STK"}, "in_threshold": 10})
+        self.assertEqual(methods["stk"].in_threshold, 10)
+        self.assertEqual(OracalTableReader.in_threshold, 512)
+        self.assertEqual(OracalTableReader(self.conn, "A").in_threshold, 512)
+
+
+class TestSingleReaderMerge(unittest.TestCase):
+
+    def series(self, rows):
+        frame = pd.DataFrame(rows, columns=["SYMBOLCODE", "TDATE", "RAWVALUE"])
+        return frame.set_index(["SYMBOLCODE", "TDATE"])["RAWVALUE"]
+
+    def test_sorted_merge(self):
+        reader = OracleSingleReader(mock.MagicMock(), "DB")
+        data = reader.merge([
+            ("F2", self.series([("000002", "20180102", 2.0), ("000001", "20180101", 1.0)])),
+            ("F1", self.series([("000001", "20180101", 3.0)])),
+        ])
+        self.assertEqual(list(data.columns), ["SYMBOLCODE", "TDATE", "F2", "F1"])
+        self.assertEqual(list(data["SYMBOLCODE"]), ["000001", "000002"])
+        self.assertEqual(list(data["F1"].fillna(-1)), [3.0, -1])
+
+    def test_keep_empty_field(self):
+        reader = OracleSingleReader(mock.MagicMock(), "DB")
+        data = reader.merge([
+            ("F1", self.series([("000001", "20180101", 1.0)])),
+            ("EMPTY", self.series([])),
+        ])
+        self.assertEqual(list(data.columns), ["SYMBOLCODE", "TDATE", "F1", "EMPTY"])
+        self.assertTrue(data["EMPTY"].isnull().all())
+
+    def test_dtypes(self):
+        reader = OracleSingleReader(mock.MagicMock(), "DB")
+        empty = pd.DataFrame(columns=["TDATE", "SYMBOLCODE", "RAWVALUE"]).set_index(["SYMBOLCODE", "TDATE"])["RAWVALUE"]
+        data = reader.merge([
+            ("F1", self.series([("000002", "20180101", 1.5), ("000001", "20180101", 2.5)])),
+            ("VOL", self.series([("000001", "20180101", 10)])),
+            ("NAME", self.series([("000001", "20180101", "a"), ("000002", "20180101", "b")])),
+            ("EMPTY", empty),
+        ])
+        self.assertEqual(data["F1"].dtype, np.float64)
+        self.assertEqual(data["VOL"].dtype, np.float64)
+        self.assertEqual(list(data["F1"]), [2.5, 1.5])
+        self.assertEqual(list(data["NAME"]), ["a", "b"])
+        self.assertTrue(data["EMPTY"].isnull().all())
+
+    def test_all_empty(self):
+        reader = OracleSingleReader(mock.MagicMock(), "DB")
+        data = reader.merge([("F1", self.series([]))])
+        self.assertEqual(list(data.columns), ["SYMBOLCODE", "TDATE", "F1"])
+        self.assertTrue(data.empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+import tempfile
+import shutil
+import sqlite3
+import os
+from threading import Thread
+from datetime import date
+import numpy as np
+from datautils.sql import make_query, sp_executesql, split_filters, OrNull
+from datautils.fxdayu.sqlite import LocalSqlite, load_conf
+
+
+class TestMakeQuery(unittest.TestCase):
+
+    def test_placeholders(self):
+        command, params = make_query("lb.income", ["b", "a"], "mssql", symbol="000001.SZ", trade_date=(20180101, None))
+        self.assertEqual(command, "select a,b from lb.income where symbol = @P1 and trade_date >= @P2")
+        self.assertEqual(params, ("000001.SZ", 20180101))
+        command, params = make_query("t", None, "qmark", symbol="x", trade_date=(None, 5))
+        self.assertEqual(command, "select * from t where symbol = ? and trade_date <= ?")
+
+    def test_stable_text(self):
+        first = make_query("t", ["a"], symbol=["x", "y", "z"], b=1)[0]
+        second = make_query("t", ["a"], b=2, symbol=["w", "v", "u", "s"])[0]
+        self.assertEqual(first, second)
+
+    def test_lists(self):
+        self.assertEqual(make_query("t", None, symbol=["a"]), ("select * from t where symbol = ?", ("a",)))
+        self.assertEqual(make_query("t", None, symbol=[])[0], "select * from t where 1 = 0")
+        command, params = make_query("t", None, symbol=["c", "a", "b"])
+        self.assertEqual(command, "select * from t where symbol in (?,?,?,?)")
+        self.assertEqual(params, ("a", "b", "c", "c"))
+
+    def test_null_and_numpy(self):
+        command, params = make_query("t", None, a=None, b=np.int64(3))
+        self.assertEqual(command, "select * from t where a is NULL and b = ?")
+        self.assertIs(type(params[0]), int)
+
+    def test_or_null(self):
+        command, params = make_query("t", None, out_date=OrNull((20180101, None)))
+        self.assertEqual(command, "select * from t where ((out_date >= ?) or out_date is NULL)")
+        self.assertEqual(params, (20180101,))
+        command, params = make_query("t", None, out_date=OrNull((1, 2)), symbol="x")
+        self.assertEqual(command, "select * from t where ((out_date >= ? and out_date <= ?) or out_date is NULL) and symbol = ?")
+        self.assertEqual(params, (1, 2, "x"))
+        self.assertEqual(make_query("t", None, out_date=OrNull((None, None))), ("select * from t", ()))
+
+
+class TestSplitFilters(unittest.TestCase):
+
+    def test_no_threshold(self):
+        filters = {"symbol": list(range(10))}
+        self.assertEqual(split_filters(filters), (filters, {}))
+
+    def test_split(self):
+        filters = {"symbol": [np.int64(i) for i in range(5)], "sector": {"a", "b"}, "trade_date": (1, 2), "code": "x"}
+        small, large = split_filters(filters, 3)
+        self.assertEqual(small, {"sector": {"a", "b"}, "trade_date": (1, 2), "code": "x"})
+        self.assertEqual(large, {"symbol": [0, 1, 2, 3, 4]})
+        self.assertIs(type(large["symbol"][0]), int)
+
+    def test_threshold_inclusive(self):
+        small, large = split_filters({"symbol": ["a", "b", "c"]}, 3)
+        self.assertEqual(large, {})
+
+
+class TestSpExecutesql(unittest.TestCase):
+
+    def test_wrap(self):
+        command, params = sp_executesql("select * from t where s = @P1 and d = @P2 and n = @P3", ("it's", date(2018, 1, 1), 1))
+        self.assertEqual(
+            command,
+            "exec sp_executesql N'select * from t where s = @P1 and d = @P2 and n = @P3', "
+            "N'@P1 varchar(8000), @P2 date, @P3 bigint', @P1=%s, @P2=%s, @P3=%s"
+        )
+        self.assertEqual(params, ("it's", date(2018, 1, 1), 1))
+
+    def test_string_type(self):
+        command, params = sp_executesql("select * from t where s = @P1", ("a",), "nvarchar(4000)")
+        self.assertIn("@P1 nvarchar(4000)", command)
+
+    def test_quote(self):
+        command, params = sp_executesql("select * from t where s like 'a%' and n = @P1", (1,))
+        self.assertIn("N'select * from t where s like ''a%%'' and n = @P1'", command)
+
+    def test_no_params(self):
+        self.assertEqual(sp_executesql("select * from t", ()), ("select * from t", None))
+
+
+class TestLocalSqlite(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.file = os.path.join(self.root, "data.sqlite")
+        conn = sqlite3.connect(self.file)
+        conn.execute("create table daily (symbol, trade_date, close)")
+        conn.executemany(
+            "insert into daily values (?, ?, ?)",
+            [("%06d" % i, 20180101 + i % 3, float(i)) for i in range(3000)]
+        )
+        conn.commit()
+        conn.close()
+        self.reader = LocalSqlite(self.file, "daily")
+        self.reader.in_threshold = 100
+
+    def tearDown(self):
+        self.reader.conn.close()
+        shutil.rmtree(self.root)
+
+    def test_temp_table_filter(self):
+        symbols = ["%06d" % i for i in range(0, 3000, 2)]
+        data = self.reader.read(["close"], symbol=symbols, trade_date=(20180102, None))
+        expected = [float(i) for i in range(0, 3000, 2) if 20180101 + i % 3 >= 20180102]
+        self.assertEqual(sorted(data["close"]), expected)
+
+    def test_conf_threshold_per_instance(self):
+        methods = load_conf({"file": self.file, "table_map": {"daily": "daily"}, "in_threshold": 3})
+        self.assertEqual(methods["daily"].in_threshold, 3)
+        self.assertEqual(LocalSqlite.in_threshold, 512)
+        self.assertEqual(LocalSqlite(self.file, "daily", conn=self.reader.conn).in_threshold, 512)
+        methods["daily"].conn.close()
+
+    def test_chunks(self):
+        chunks = list(self.reader.iter_read(["close"], chunk_size=1000))
+        self.assertEqual([len(chunk) for chunk in chunks], [1000, 1000, 1000])
+
+    def test_interleaved_iter_read(self):
+        symbols = ["%06d" % i for i in range(1000)]
+        first = self.reader.iter_read(["close"], chunk_size=100, symbol=symbols)
+        second = self.reader.iter_read(["close"], chunk_size=100, symbol=symbols)
+        rows = len(next(first)) + len(next(second))
+        rows += sum([len(chunk) for chunk in first])
+        rows += sum([len(chunk) for chunk in second])
+        self.assertEqual(rows, 2000)
+
+    def test_paused_reader_does_not_block_threads(self):
+        paused = self.reader.iter_read(["close"], chunk_size=100)
+        next(paused)
+        result = []
+        thread = Thread(target=lambda: result.append(len(self.reader.read(["close"], symbol="000001"))))
+        thread.start()
+        thread.join(5)
+        self.assertEqual(result, [1])
+        paused.close()
+
+
+if __name__ == '__main__':
+    unittest.main()